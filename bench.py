@@ -0,0 +1,305 @@
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import statistics
+import time
+import types
+
+import asyncpg
+
+import bot
+
+# the day the benchmark pretends it is, windows are 06:00 to 08:00 UTC
+BENCH_DATE = datetime.date(2024, 1, 8)
+WINDOW_START = datetime.time(6)
+WINDOW_END = datetime.time(8)
+
+# channel ids of the fake guild
+TEXT_CHANNEL = 1
+VOICE_CHANNEL = 2
+OTHER_CHANNEL = 3
+
+
+class FakeClock:
+    """Stands in for bot.current_datetime."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def datetime(self):
+        return self.now
+
+    def set(self, now):
+        self.now = now
+
+
+class FakeChannel:
+    def __init__(self, id):
+        self.id = id
+        self.name = f"channel-{id}"
+        self.mention = f"<#{id}>"
+        self.sent = 0
+
+    async def send(self, message=None, file=None, embed=None, view=None):
+        self.sent += 1
+
+
+class FakeGuild:
+    """Just enough of a discord.Guild for RiseNGrind, without a gateway."""
+
+    def __init__(self, id):
+        self.id = id
+        self.channels = [FakeChannel(TEXT_CHANNEL), FakeChannel(VOICE_CHANNEL)]
+        self.members = []
+
+    def get_channel(self, id):
+        return next((channel for channel in self.channels if channel.id == id), None)
+
+    def get_member(self, mid):
+        return None
+
+    async def fetch_member(self, mid):
+        return types.SimpleNamespace(display_name=f"member-{mid}")
+
+
+class FakeContext:
+    def __init__(self, guild):
+        self.guild = guild
+        self.channel = FakeChannel(0)
+        self.author = fake_user(0, guild)
+
+
+def fake_user(mid, guild):
+    return types.SimpleNamespace(
+        id=mid, guild=guild, mention=f"<@{mid}>", display_name=f"member-{mid}"
+    )
+
+
+def voice_events(rng, guild, mids, count, noise):
+    """Yields (user, before, after) voice state updates and whether they are a
+    member joining the voice channel. A noise fraction of them are mutes, other
+    channels or untracked users, like on a real gateway."""
+    voice = types.SimpleNamespace(id=VOICE_CHANNEL)
+    other = types.SimpleNamespace(id=OTHER_CHANNEL)
+    for _ in range(count):
+        mid = rng.choice(mids)
+        kind = rng.random()
+        join = kind >= noise
+        if join:
+            before, after = None, voice
+        elif kind < noise / 3:
+            before, after = voice, voice  # mute, deafen, stream...
+        elif kind < 2 * noise / 3:
+            before, after = None, other
+        else:
+            mid = -mid  # not a member
+            before, after = None, voice
+        event = (
+            fake_user(mid, guild),
+            types.SimpleNamespace(channel=before),
+            types.SimpleNamespace(channel=after),
+        )
+        yield event, join
+
+
+def percentiles(latencies):
+    if len(latencies) < 2:
+        return latencies * 2 or [0, 0]
+    cuts = statistics.quantiles(latencies, n=100)
+    return cuts[49], cuts[98]
+
+
+def report(name, latencies):
+    p50, p99 = percentiles(latencies)
+    print(f"{name}: p50 {p50 * 1000:.3f}ms, p99 {p99 * 1000:.3f}ms")
+
+
+def queries(risengrind, *tags):
+    """Returns how many queries have been made for tags so far."""
+    return sum(
+        sum(counts)
+        for (query_tag, _), (counts, _) in risengrind.query_latency.series.items()
+        if query_tag in tags
+    )
+
+
+async def create_database(args):
+    con = await asyncpg.connect(
+        database="postgres",
+        user=args.db_user,
+        password=args.db_pass,
+        host=args.db_host,
+        port=args.db_port,
+    )
+    try:
+        await con.execute(f'DROP DATABASE IF EXISTS "{args.db_name}";')
+        await con.execute(f'CREATE DATABASE "{args.db_name}";')
+    finally:
+        await con.close()
+
+
+async def populate(risengrind, guild, mids):
+    """Adds mids as active members with the same window and reloads the bot."""
+    async with risengrind.db.acquire() as con:
+        await con.execute(
+            "UPDATE configs SET text_channel = $1, voice_channel = $2 WHERE gid = $3;",
+            TEXT_CHANNEL,
+            VOICE_CHANNEL,
+            guild.id,
+        )
+        await con.copy_records_to_table(
+            "members",
+            records=[
+                (guild.id, mid, WINDOW_START, WINDOW_END, True, True) for mid in mids
+            ],
+            columns=["gid", "mid", "start_time", "end_time", "weekends", "active"],
+        )
+        deadline = (
+            datetime.datetime.combine(BENCH_DATE, WINDOW_END) + bot.DEADLINE_GRACE
+        )
+        await con.copy_records_to_table(
+            "schedules",
+            records=[(guild.id, mid, deadline) for mid in mids],
+            columns=["gid", "mid", "deadline"],
+        )
+    await risengrind.reload()
+
+
+async def run_events(risengrind, events, concurrency):
+    """Feeds events to on_voice_state_update, concurrency at a time like the
+    gateway dispatching them as tasks, returns the latencies of all of them and of
+    the joins."""
+    latencies = []
+    joins = []
+
+    async def handle(event, join):
+        start = time.perf_counter()
+        await risengrind.on_voice_state_update(*event)
+        latency = time.perf_counter() - start
+        latencies.append(latency)
+        if join:
+            joins.append(latency)
+
+    batch = []
+    for event, join in events:
+        batch.append(handle(event, join))
+        if len(batch) == concurrency:
+            await asyncio.gather(*batch)
+            batch = []
+    await asyncio.gather(*batch)
+    return latencies, joins
+
+
+async def run_commands(risengrind, guild, mids, repeat):
+    """Times the commands that read the most, returns name -> latencies."""
+    ctx = FakeContext(guild)
+    commands = {
+        "info": lambda: risengrind.info.callback(risengrind, ctx),
+        "stats": lambda: risengrind.stats.callback(
+            risengrind, ctx, fake_user(mids[0], guild)
+        ),
+        "leaderboard": lambda: risengrind.leaderboard.callback(risengrind, ctx, 25),
+    }
+    timings = {}
+    for name, command in commands.items():
+        timings[name] = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await command()
+            timings[name].append(time.perf_counter() - start)
+    return timings
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks RiseNGrind against a local postgres with a fake "
+        "gateway and clock. The database is dropped and recreated."
+    )
+    parser.add_argument("--members", type=int, default=10000)
+    parser.add_argument("--events", type=int, default=50000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument(
+        "--noise", type=float, default=0.8, help="fraction of events that are ignored"
+    )
+    parser.add_argument("--commands", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db-name", default="risengrind_bench")
+    parser.add_argument("--db-user", default=os.environ.get("DB_USER", "postgres"))
+    parser.add_argument("--db-pass", default=os.environ.get("DB_PASS", ""))
+    parser.add_argument("--db-host", default=os.environ.get("DB_HOST", "localhost"))
+    parser.add_argument("--db-port", default=os.environ.get("DB_PORT", "5432"))
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    clock = FakeClock(datetime.datetime.combine(BENCH_DATE, datetime.time(7)))
+    bot.current_datetime = clock.datetime
+
+    await create_database(args)
+    guild = FakeGuild(1)
+    risengrind = bot.RiseNGrind(
+        bot=types.SimpleNamespace(guilds=[guild], users=[]),
+        guild_id=0,
+        db_name=args.db_name,
+        db_user=args.db_user,
+        db_pass=args.db_pass,
+        db_host=args.db_host,
+        db_port=args.db_port,
+        metrics_port=0,
+        slow_query=float("inf"),
+        # the outbox is left out, closing gives up on it after a second
+        shutdown_timeout=1,
+    )
+    await risengrind.on_ready()
+    # the benchmark runs the end of window itself, on the fake clock
+    risengrind.unlead()
+
+    mids = list(range(1, args.members + 1))
+    await populate(risengrind, guild, mids)
+    state = risengrind.guilds[guild.id]
+
+    # voice joins during the window
+    events = list(voice_events(rng, guild, mids, args.events, args.noise))
+    start = time.perf_counter()
+    latencies, joins = await run_events(risengrind, events, args.concurrency)
+    # joins are written behind, the last batch is part of the run
+    await risengrind.joins.drain()
+    elapsed = time.perf_counter() - start
+    voice_queries = queries(risengrind, "on_voice_state_update", "write_joins")
+
+    # every window closes at the same time. the outbox paces itself to discord's
+    # rate limits so it is left out
+    deadline = datetime.datetime.combine(BENCH_DATE, WINDOW_END) + bot.DEADLINE_GRACE
+    clock.set(deadline)
+    start = time.perf_counter()
+    await risengrind.end_window(state, deadline, mids)
+    burst = time.perf_counter() - start
+    burst_queries = queries(risengrind, "end_window")
+    sleepers = await risengrind.db.fetchval(
+        "SELECT count(*) FROM mornings WHERE notified AND NOT woke_up;"
+    )
+
+    timings = await run_commands(risengrind, guild, mids, args.commands)
+
+    print(f"members: {args.members}, events: {args.events} ({args.noise:.0%} noise)")
+    print(f"startup: {risengrind.startup * 1000:.1f}ms")
+    print(
+        f"voice events: {len(events) / elapsed:.0f} events/s, "
+        f"{voice_queries / len(events):.3f} queries/event, "
+        f"{voice_queries / max(len(joins), 1):.3f} queries/join"
+    )
+    report("  all events", latencies)
+    report("  joins", joins)
+    print(
+        f"end of window burst: {len(mids)} members in {burst * 1000:.1f}ms, "
+        f"{burst_queries} queries, {sleepers} slept in"
+    )
+    for name, latencies in timings.items():
+        report(f"!{name}", latencies)
+
+    await risengrind.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,14 +1,31 @@
 import argparse
 import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import csv
 import datetime
+import functools
+import gzip
+import heapq
+import io
+import json
+import logging
 import os
 import random
+import resource
+import signal
+import tempfile
 import time
+import traceback
+import uuid
+import zoneinfo
+from typing import Optional
 
 import asyncpg
 import discord
-from discord.ext import commands, tasks
-from discord.utils import find
+from discord.ext import commands
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -51,24 +68,577 @@ sleep_messages = {
     ],
 }
 
+# discord rejects messages longer than this
+DISCORD_MESSAGE_LIMIT = 2000
+
+# seconds the outbox waits for more messages to the same channel before posting
+OUTBOX_WINDOW = 0.25
+
+# seconds close() waits for in-flight work before giving up on it, below fly's
+# kill_timeout
+SHUTDOWN_TIMEOUT = 10
+
+# seconds voice joins are collected for before they are written and greeted in
+# one go
+JOIN_BATCH_WINDOW = 0.25
+
+# times the outbox tries a post before dropping it, waiting SEND_BACKOFF seconds
+# after the first failure and twice as long after each one after that
+SEND_ATTEMPTS = 4
+SEND_BACKOFF = 1
+
+# discord allows about this many messages per channel every CHANNEL_PERIOD seconds
+CHANNEL_RATE = 5
+CHANNEL_PERIOD = 5
+
+# key of the advisory lock held by the leader, every replica has to agree on it
+LEADER_LOCK = 0x52495345
+
+# seconds between attempts to take the leader lock and between leader heartbeats
+LEADER_INTERVAL = 5
+
+# key of the advisory lock held while migrating, so only one instance migrates
+MIGRATION_LOCK = 0x52495346
+
+# schema migrations, a migration's version is its position in the list (starting
+# at 1) so new migrations must only ever be appended
+MIGRATIONS = [
+    # 1: members, mornings and a blank config
+    """
+    CREATE TABLE IF NOT EXISTS members (
+        mid BIGINT NOT NULL,
+        start_time TIME(0) NOT NULL,
+        end_time TIME(0) NOT NULL,
+        weekends BOOLEAN NOT NULL,
+        active BOOLEAN NOT NULL DEFAULT false,
+        PRIMARY KEY (mid)
+    );
+    CREATE TABLE IF NOT EXISTS mornings (
+        mid BIGINT NOT NULL,
+        date DATE NOT NULL,
+        woke_up BOOLEAN NOT NULL DEFAULT false,
+        notified BOOLEAN NOT NULL DEFAULT false,
+        FOREIGN KEY (mid) REFERENCES members ON DELETE CASCADE,
+        PRIMARY KEY (mid, date)
+    );
+    CREATE TABLE IF NOT EXISTS configs (
+        cid INTEGER NOT NULL,
+        text_channel BIGINT,
+        voice_channel BIGINT,
+        PRIMARY KEY (cid)
+    );
+    INSERT INTO configs (cid) VALUES (0) ON CONFLICT DO NOTHING;
+    """,
+    # 2: persisted end of window deadlines
+    """
+    CREATE TABLE IF NOT EXISTS schedules (
+        mid BIGINT NOT NULL,
+        deadline TIMESTAMP NOT NULL,
+        FOREIGN KEY (mid) REFERENCES members ON DELETE CASCADE,
+        PRIMARY KEY (mid)
+    );
+    """,
+    # 3: per member streaks and totals, backfilled from mornings. a member's
+    # streaks are the runs of woken up mornings between missed ones
+    """
+    CREATE TABLE IF NOT EXISTS member_stats (
+        mid BIGINT NOT NULL,
+        current_streak INTEGER NOT NULL DEFAULT 0,
+        longest_streak INTEGER NOT NULL DEFAULT 0,
+        total_woke_up INTEGER NOT NULL DEFAULT 0,
+        total_missed INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (mid) REFERENCES members ON DELETE CASCADE,
+        PRIMARY KEY (mid)
+    );
+    CREATE INDEX IF NOT EXISTS member_stats_leaderboard
+        ON member_stats (current_streak DESC, longest_streak DESC, mid);
+    INSERT INTO member_stats
+    SELECT mid,
+        (array_agg(length ORDER BY run DESC))[1],
+        max(length),
+        sum(length),
+        max(run)
+    FROM (
+        SELECT mid, run, count(*) FILTER (WHERE woke_up) AS length
+        FROM (
+            SELECT mid, woke_up, count(*) FILTER (WHERE NOT woke_up) OVER (
+                PARTITION BY mid ORDER BY date
+            ) AS run
+            FROM mornings
+            WHERE notified
+        ) AS outcomes
+        GROUP BY mid, run
+    ) AS runs
+    GROUP BY mid
+    ON CONFLICT DO NOTHING;
+    """,
+    # 4: date index and the tables old mornings are rolled up and archived into
+    """
+    CREATE INDEX IF NOT EXISTS mornings_date ON mornings (date);
+    CREATE TABLE IF NOT EXISTS mornings_monthly (
+        mid BIGINT NOT NULL,
+        month DATE NOT NULL,
+        woke_up INTEGER NOT NULL DEFAULT 0,
+        missed INTEGER NOT NULL DEFAULT 0,
+        days INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (mid) REFERENCES members ON DELETE CASCADE,
+        PRIMARY KEY (mid, month)
+    );
+    CREATE TABLE IF NOT EXISTS mornings_archive (LIKE mornings INCLUDING DEFAULTS);
+    """,
+    # 5: every row belongs to a guild. rows from before there were guilds get gid 0
+    # until their guild adopts them on startup, see adopt_guild
+    """
+    ALTER TABLE configs RENAME COLUMN cid TO gid;
+    ALTER TABLE configs ALTER COLUMN gid TYPE BIGINT;
+    ALTER TABLE members ADD COLUMN gid BIGINT NOT NULL DEFAULT 0;
+    ALTER TABLE mornings ADD COLUMN gid BIGINT NOT NULL DEFAULT 0;
+    ALTER TABLE mornings_archive ADD COLUMN gid BIGINT NOT NULL DEFAULT 0;
+    ALTER TABLE mornings_monthly ADD COLUMN gid BIGINT NOT NULL DEFAULT 0;
+    ALTER TABLE schedules ADD COLUMN gid BIGINT NOT NULL DEFAULT 0;
+    ALTER TABLE member_stats ADD COLUMN gid BIGINT NOT NULL DEFAULT 0;
+    ALTER TABLE members ALTER COLUMN gid DROP DEFAULT;
+    ALTER TABLE mornings ALTER COLUMN gid DROP DEFAULT;
+    ALTER TABLE mornings_archive ALTER COLUMN gid DROP DEFAULT;
+    ALTER TABLE mornings_monthly ALTER COLUMN gid DROP DEFAULT;
+    ALTER TABLE schedules ALTER COLUMN gid DROP DEFAULT;
+    ALTER TABLE member_stats ALTER COLUMN gid DROP DEFAULT;
+
+    -- partitioning mornings leaves its foreign key with a different name
+    DO $$
+    DECLARE
+        name TEXT;
+    BEGIN
+        FOR name IN
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = 'mornings'::regclass AND contype = 'f'
+        LOOP
+            EXECUTE format('ALTER TABLE mornings DROP CONSTRAINT %I', name);
+        END LOOP;
+    END $$;
+    ALTER TABLE mornings_monthly DROP CONSTRAINT mornings_monthly_mid_fkey;
+    ALTER TABLE schedules DROP CONSTRAINT schedules_mid_fkey;
+    ALTER TABLE member_stats DROP CONSTRAINT member_stats_mid_fkey;
+
+    ALTER TABLE members DROP CONSTRAINT members_pkey, ADD PRIMARY KEY (gid, mid);
+    ALTER TABLE mornings DROP CONSTRAINT mornings_pkey, ADD PRIMARY KEY (gid, mid, date);
+    ALTER TABLE mornings_monthly DROP CONSTRAINT mornings_monthly_pkey,
+        ADD PRIMARY KEY (gid, mid, month);
+    ALTER TABLE schedules DROP CONSTRAINT schedules_pkey, ADD PRIMARY KEY (gid, mid);
+    ALTER TABLE member_stats DROP CONSTRAINT member_stats_pkey,
+        ADD PRIMARY KEY (gid, mid);
+
+    ALTER TABLE mornings ADD FOREIGN KEY (gid, mid) REFERENCES members
+        ON DELETE CASCADE ON UPDATE CASCADE;
+    ALTER TABLE mornings_monthly ADD FOREIGN KEY (gid, mid) REFERENCES members
+        ON DELETE CASCADE ON UPDATE CASCADE;
+    ALTER TABLE schedules ADD FOREIGN KEY (gid, mid) REFERENCES members
+        ON DELETE CASCADE ON UPDATE CASCADE;
+    ALTER TABLE member_stats ADD FOREIGN KEY (gid, mid) REFERENCES members
+        ON DELETE CASCADE ON UPDATE CASCADE;
+
+    DROP INDEX member_stats_leaderboard;
+    CREATE INDEX member_stats_leaderboard
+        ON member_stats (gid, current_streak DESC, longest_streak DESC, mid);
+    """,
+    # 6: per member timezones, members without one use the bot's default timezone
+    """
+    ALTER TABLE members ADD COLUMN tz TEXT;
+    """,
+]
+
+# channel member and config changes are published on so that every instance can
+# keep its cache up to date
+CHANGES_CHANNEL = "risengrind_changes"
+
+# seconds between pings of the listening connection and between reconnect attempts
+LISTEN_INTERVAL = 30
+
+# most members !leaderboard lists
+LEADERBOARD_LIMIT = 25
+
+# seconds between retention runs
+RETENTION_INTERVAL = 6 * 60 * 60
+
+# most mornings rows a single retention batch deletes
+RETENTION_BATCH = 1000
+
+# how many months ahead partitions of mornings are created when it's partitioned
+PARTITION_MONTHS_AHEAD = 2
+
+# exports bigger than this are spooled to a temporary file instead of memory
+EXPORT_SPOOL_SIZE = 4 * 1024 * 1024
+
+# members per !info page, and seconds its buttons keep working
+INFO_PAGE_SIZE = 20
+INFO_TIMEOUT = 300
+
+# most invalid rows an import reports before giving up on it
+IMPORT_ERRORS = 10
+
+# display names of members the gateway doesn't cache, kept in a bounded lru
+NAME_CACHE_SIZE = 1024
+
+# port the prometheus metrics endpoint listens on (fly.toml's internal_port), 0
+# turns it off
+METRICS_PORT = 8080
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# seconds between event loop lag samples
+LAG_INTERVAL = 1
+
+# queries that take longer than this many seconds are logged with their arguments
+SLOW_QUERY_SECONDS = 0.5
+
+# connection pool defaults, a handful of connections is plenty for one guild and
+# hosted postgres plans only allow so many
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 10
+
+# seconds an idle pool connection is kept open
+POOL_IDLE_LIFETIME = 300
+
+# prepared statements asyncpg caches per connection
+STATEMENT_CACHE_SIZE = 100
+
+# seconds a cached statement is kept, 0 keeps it as long as its connection. the
+# statements prepared when a connection opens are used once a day by the sweep,
+# and asyncpg's default of 300 would drop them long before that
+STATEMENT_CACHE_LIFETIME = 0
+
+# statements EXPLAIN ANALYZE can run
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "VALUES")
+
+# timezone of members that haven't set one, deadlines are kept in UTC
+DEFAULT_TIMEZONE = "UTC"
+
+# how long after a window ends its deadline is, for good measure
+DEADLINE_GRACE = datetime.timedelta(seconds=10)
+
+# the command or listener the current task is running queries for
+query_tag = contextvars.ContextVar("query_tag", default="")
+
+logger = logging.getLogger("risengrind")
+
+# upserts the mornings rows of every member of guild $1 in $2 for the matching
+# date in $3 with woke_up=$4 and notified=$5. rows that have already been notified
+# are left alone.
+# every row that becomes notified is an outcome and is counted into member_stats in
+# the same statement: waking up extends the member's streak and sleeping in resets
+# it
+UPSERTED_MORNINGS = """
+upserted AS (
+    INSERT INTO mornings (gid, mid, date, woke_up, notified)
+    SELECT $1::bigint, mid, date, $4::boolean, $5::boolean
+    FROM unnest($2::bigint[], $3::date[]) AS morning(mid, date)
+    ON CONFLICT (gid, mid, date) DO UPDATE
+    SET woke_up = EXCLUDED.woke_up, notified = EXCLUDED.notified
+    WHERE EXCLUDED.notified AND NOT mornings.notified
+    RETURNING gid, mid, woke_up, notified
+), counted AS (
+    INSERT INTO member_stats AS stats
+        (gid, mid, current_streak, longest_streak, total_woke_up, total_missed)
+    SELECT gid, mid, woke_up::int, woke_up::int, woke_up::int, (NOT woke_up)::int
+    FROM upserted
+    WHERE notified
+    ON CONFLICT (gid, mid) DO UPDATE SET
+        current_streak = CASE
+            WHEN EXCLUDED.total_woke_up > 0 THEN stats.current_streak + 1 ELSE 0
+        END,
+        longest_streak = GREATEST(
+            stats.longest_streak, stats.current_streak + EXCLUDED.total_woke_up
+        ),
+        total_woke_up = stats.total_woke_up + EXCLUDED.total_woke_up,
+        total_missed = stats.total_missed + EXCLUDED.total_missed
+)
+"""
+
+# returns the rows that were inserted or changed, the ones with notified set are
+# the members that need a message. asyncpg's statement cache prepares this once
+# per connection
+UPSERT_MORNINGS = "\nWITH" + UPSERTED_MORNINGS + "SELECT mid, notified FROM upserted;\n"
+
+# UPSERT_MORNINGS for the members whose window closed at deadline $6, also moving
+# their persisted deadline to the matching next deadline in $7. members whose
+# deadline has already been moved past $6 are left alone so sweeping the same
+# deadline twice is harmless
+SWEEP_MORNINGS = (
+    """
+WITH advanced AS (
+    UPDATE schedules SET deadline = next.deadline
+    FROM unnest($2::bigint[], $7::timestamp[]) AS next(mid, deadline)
+    WHERE schedules.gid = $1 AND schedules.mid = next.mid
+        AND schedules.deadline <= $6
+),"""
+    + UPSERTED_MORNINGS
+    + "SELECT mid, notified FROM upserted;\n"
+)
+
+# marks the mornings of the windows that closed while the bot was down ($1, $2
+# and $3 are their gids, mids and dates) as missed and moves the persisted
+# deadlines of $4, $5 to $6 unless they are already past $7. returns the mornings
+# that were missed, re-running it is a no-op
+CATCH_UP_MORNINGS = """
+WITH advanced AS (
+    UPDATE schedules
+    SET deadline = next.deadline
+    FROM unnest($4::bigint[], $5::bigint[], $6::timestamp[]) AS next(gid, mid, deadline)
+    WHERE schedules.gid = next.gid AND schedules.mid = next.mid
+        AND schedules.deadline <= $7
+), marked AS (
+    INSERT INTO mornings (gid, mid, date, notified)
+    SELECT gid, mid, date, true
+    FROM unnest($1::bigint[], $2::bigint[], $3::date[]) AS missed(gid, mid, date)
+    ON CONFLICT (gid, mid, date) DO UPDATE SET notified = true
+    WHERE NOT mornings.notified
+    RETURNING gid, mid, date
+), counted AS (
+    INSERT INTO member_stats AS stats (gid, mid, total_missed)
+    SELECT gid, mid, count(*) FROM marked GROUP BY gid, mid
+    ON CONFLICT (gid, mid) DO UPDATE SET
+        current_streak = 0,
+        total_missed = stats.total_missed + EXCLUDED.total_missed
+)
+SELECT gid, mid, date FROM marked;
+"""
+
+# folds the rows of the expired CTE into mornings_monthly
+ROLL_UP_EXPIRED = """
+rolled AS (
+    INSERT INTO mornings_monthly AS monthly (gid, mid, month, woke_up, missed, days)
+    SELECT
+        gid,
+        mid,
+        date_trunc('month', date)::date,
+        count(*) FILTER (WHERE woke_up),
+        count(*) FILTER (WHERE notified AND NOT woke_up),
+        count(*)
+    FROM expired
+    GROUP BY 1, 2, 3
+    ON CONFLICT (gid, mid, month) DO UPDATE SET
+        woke_up = monthly.woke_up + EXCLUDED.woke_up,
+        missed = monthly.missed + EXCLUDED.missed,
+        days = monthly.days + EXCLUDED.days
+)"""
+
+# deletes up to $2 mornings from before $1, rolling them up into mornings_monthly,
+# and returns how many were deleted
+ROLL_UP_MORNINGS = (
+    """
+WITH expired AS (
+    DELETE FROM mornings
+    WHERE (gid, mid, date) IN (
+        SELECT gid, mid, date FROM mornings WHERE date < $1 ORDER BY date LIMIT $2
+    )
+    RETURNING *
+),"""
+    + ROLL_UP_EXPIRED
+    + """
+SELECT count(*) FROM expired;
+"""
+)
+
+# ROLL_UP_MORNINGS that also keeps the deleted rows in mornings_archive
+ARCHIVE_MORNINGS = (
+    """
+WITH expired AS (
+    DELETE FROM mornings
+    WHERE (gid, mid, date) IN (
+        SELECT gid, mid, date FROM mornings WHERE date < $1 ORDER BY date LIMIT $2
+    )
+    RETURNING *
+), archived AS (
+    INSERT INTO mornings_archive SELECT * FROM expired
+),"""
+    + ROLL_UP_EXPIRED
+    + """
+SELECT count(*) FROM expired;
+"""
+)
+
+
+# the config, members and schedules of the guilds in $1 in a single round trip,
+# creating the configs of guilds that don't have one yet
+LOAD_GUILDS = """
+WITH inserted AS (
+    INSERT INTO configs (gid) SELECT unnest($1::bigint[])
+    ON CONFLICT (gid) DO NOTHING
+    RETURNING *
+)
+SELECT
+    ARRAY(
+        SELECT config FROM configs AS config WHERE gid = ANY($1::bigint[])
+        UNION ALL
+        SELECT inserted::configs FROM inserted
+    ) AS configs,
+    ARRAY(
+        SELECT member FROM members AS member WHERE gid = ANY($1::bigint[])
+    ) AS members,
+    ARRAY(
+        SELECT schedule FROM schedules AS schedule WHERE gid = ANY($1::bigint[])
+    ) AS schedules;
+"""
+
+# a page of guild $1's members after mid $2 (keyset pagination, at most $3), with
+# their current streak and the date and outcome of their latest morning since $4
+MEMBERS_PAGE = """
+SELECT
+    members.*,
+    coalesce(stats.current_streak, 0) AS current_streak,
+    morning.date AS morning_date,
+    morning.woke_up,
+    morning.notified
+FROM members
+LEFT JOIN member_stats AS stats USING (gid, mid)
+LEFT JOIN LATERAL (
+    SELECT date, woke_up, notified FROM mornings
+    WHERE mornings.gid = members.gid AND mornings.mid = members.mid
+        AND mornings.date >= $4
+    ORDER BY mornings.date DESC
+    LIMIT 1
+) AS morning ON true
+WHERE members.gid = $1 AND members.mid > $2
+ORDER BY members.mid
+LIMIT $3;
+"""
+
+# merges the members staged by an import into members, the last row wins when a
+# member is in the file twice. active members keep their settings, like with
+# !update. returns the rows that were added or updated
+MERGE_MEMBERS = """
+INSERT INTO members (gid, mid, start_time, end_time, weekends, tz)
+SELECT DISTINCT ON (mid) gid, mid, start_time, end_time, weekends, tz
+FROM import_members
+ORDER BY mid, ctid DESC
+ON CONFLICT (gid, mid) DO UPDATE SET
+    start_time = EXCLUDED.start_time,
+    end_time = EXCLUDED.end_time,
+    weekends = EXCLUDED.weekends,
+    tz = EXCLUDED.tz
+WHERE NOT members.active
+RETURNING mid;
+"""
+
+# merges the mornings staged by an import into mornings, replacing the ones that
+# already exist. mornings of members that aren't in the club are skipped. returns
+# the members whose mornings were merged
+MERGE_MORNINGS = """
+WITH merged AS (
+    INSERT INTO mornings (gid, mid, date, woke_up, notified)
+    SELECT DISTINCT ON (mid, date) gid, mid, date, woke_up, notified
+    FROM import_mornings JOIN members USING (gid, mid)
+    ORDER BY mid, date, import_mornings.ctid DESC
+    ON CONFLICT (gid, mid, date) DO UPDATE SET
+        woke_up = EXCLUDED.woke_up, notified = EXCLUDED.notified
+    RETURNING mid
+)
+SELECT mid, count(*) FROM merged GROUP BY mid;
+"""
+
+# recomputes the member_stats of the members of guild $1 in $2 from scratch, like
+# migration 3 but counting the months retention rolled up into the totals
+RECOMPUTE_STATS = """
+INSERT INTO member_stats AS stats
+    (gid, mid, current_streak, longest_streak, total_woke_up, total_missed)
+SELECT
+    runs.gid,
+    runs.mid,
+    (array_agg(length ORDER BY run DESC))[1],
+    max(length),
+    sum(length) + coalesce(max(monthly.woke_up), 0),
+    max(run) + coalesce(max(monthly.missed), 0)
+FROM (
+    SELECT gid, mid, run, count(*) FILTER (WHERE woke_up) AS length
+    FROM (
+        SELECT gid, mid, woke_up, count(*) FILTER (WHERE NOT woke_up) OVER (
+            PARTITION BY mid ORDER BY date
+        ) AS run
+        FROM mornings
+        WHERE gid = $1 AND mid = ANY($2::bigint[]) AND notified
+    ) AS outcomes
+    GROUP BY gid, mid, run
+) AS runs
+LEFT JOIN (
+    SELECT mid, sum(woke_up) AS woke_up, sum(missed) AS missed
+    FROM mornings_monthly
+    WHERE gid = $1 AND mid = ANY($2::bigint[])
+    GROUP BY mid
+) AS monthly USING (mid)
+GROUP BY runs.gid, runs.mid
+ON CONFLICT (gid, mid) DO UPDATE SET
+    current_streak = EXCLUDED.current_streak,
+    longest_streak = GREATEST(stats.longest_streak, EXCLUDED.longest_streak),
+    total_woke_up = EXCLUDED.total_woke_up,
+    total_missed = EXCLUDED.total_missed;
+"""
+
+# statements on the hot paths that every pool connection prepares when it opens
+PREPARED = (UPSERT_MORNINGS, SWEEP_MORNINGS)
+
 
 def current_datetime():
-    return datetime.datetime.now()
+    """Returns the current time in UTC, without a tzinfo like the deadlines."""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def env_flag(name):
+    return os.environ.get(name, "").lower() in ("1", "t", "true", "y", "yes")
+
+
+def parse_date(arg):
+    return datetime.datetime.strptime(arg, "%Y-%m-%d").date()
 
 
-def current_time():
-    return datetime.datetime.now().time()
+def parse_time(arg):
+    return datetime.datetime.strptime(arg, "%H:%M:%S").time()
+
+
+def parse_bool(arg):
+    value = arg.strip().lower()
+    if value in ("1", "t", "true", "y", "yes"):
+        return True
+    if value in ("0", "f", "false", "n", "no"):
+        return False
+    raise ValueError(f"{arg!r} is not yes or no")
+
+
+def parse_id(arg):
+    """Returns arg as a discord id, which postgres keeps in a bigint."""
+    value = int(arg)
+    if not 0 < value < 2**63:
+        raise ValueError(f"{arg!r} is not a discord id")
+    return value
+
+
+def parse_timezone(arg):
+    """Returns arg if it's a known timezone, or None if it's blank."""
+    if not arg:
+        return None
+    try:
+        zoneinfo.ZoneInfo(arg)
+    except zoneinfo.ZoneInfoNotFoundError:
+        raise ValueError(f"unknown timezone {arg!r}")
+    return arg
 
 
 def is_a_weekend(date):
     return date.weekday() >= 5
 
 
-def in_time_range(start, now, end):
-    if start < end:
-        return now >= start and now <= end
-    else:  # time interval crosses midnight
-        return now >= start or now <= end
+def to_utc(date, time, zone, latest=False):
+    """Returns the local date and time in zone as a UTC datetime without a
+    tzinfo. A time the clocks skip over or repeat when daylight saving time
+    changes can be read two ways, the earliest is returned unless latest."""
+    readings = [
+        datetime.datetime.combine(date, time, tzinfo=zone)
+        .replace(fold=fold)
+        .astimezone(datetime.timezone.utc)
+        .replace(tzinfo=None)
+        for fold in (0, 1)
+    ]
+    return max(readings) if latest else min(readings)
 
 
 # TODO
@@ -78,6 +648,12 @@ def check():
     pass
 
 
+def max_rss():
+    """Returns the peak resident memory of the process in bytes."""
+    # linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 def get_random_message(message_list, mention):
     message, url_list = random.choice(list(message_list.items()))
     message = message.format(mention)
@@ -85,110 +661,1813 @@ def get_random_message(message_list, mention):
     return message + "\n" + url
 
 
+def mention(mid):
+    return f"<@{mid}>"
+
+
+def split_message(message, limit=DISCORD_MESSAGE_LIMIT):
+    """Splits message into chunks that fit in a discord message, breaking on
+    newlines or spaces where possible."""
+    chunks = []
+    while len(message) > limit:
+        cut = message.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            cut = message.rfind(" ", 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        chunks.append(message[:cut])
+        message = message[cut:].lstrip("\n ")
+    chunks.append(message)
+    return chunks
+
+
+async def migrate(con):
+    """Applies any pending migrations, returns the schema version."""
+    # fast path, a single query when the schema is already up to date
+    try:
+        version = await con.fetchval("SELECT max(version) FROM schema_version;")
+    except asyncpg.UndefinedTableError:
+        version = None
+    if version is not None and version >= len(MIGRATIONS):
+        return version
+
+    async with con.transaction():
+        # instances starting at the same time wait here for the first one to
+        # finish migrating, then find nothing left to apply
+        await con.execute("SELECT pg_advisory_xact_lock($1);", MIGRATION_LOCK)
+        await con.execute(
+            """
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (version)
+        );
+        """
+        )
+        version = await con.fetchval(
+            "SELECT coalesce(max(version), 0) FROM schema_version;"
+        )
+        for version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            print(f"applying migration {version}")
+            await con.execute(migration)
+            await con.execute(
+                "INSERT INTO schema_version (version) VALUES ($1);", version
+            )
+    return version
+
+
+async def adopt_guild(con, gid):
+    """Moves the rows from before there were guilds (gid 0) to guild gid."""
+    async with con.transaction():
+        await con.execute("SELECT pg_advisory_xact_lock($1);", MIGRATION_LOCK)
+        config = await con.fetchrow("DELETE FROM configs WHERE gid = 0 RETURNING *;")
+        if config is None:
+            return
+        print(f"adopting the rows from before multi guild support into {gid}")
+        await con.execute(
+            "INSERT INTO configs (gid, text_channel, voice_channel) "
+            "VALUES ($1, $2, $3) ON CONFLICT (gid) DO NOTHING;",
+            gid,
+            config["text_channel"],
+            config["voice_channel"],
+        )
+        # everything but the archive follows its member through the foreign keys
+        await con.execute("UPDATE members SET gid = $1 WHERE gid = 0;", gid)
+        await con.execute("UPDATE mornings_archive SET gid = $1 WHERE gid = 0;", gid)
+
+
+def month_of(date):
+    return date.replace(day=1)
+
+
+def next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def partition_name(month):
+    return f"mornings_{month:%Y_%m}"
+
+
+async def is_partitioned(con):
+    return await con.fetchval(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = 'mornings'::regclass;"
+    )
+
+
+def partitions_ahead(date):
+    """Returns the last date partitions of mornings should exist for."""
+    return date + datetime.timedelta(days=31 * PARTITION_MONTHS_AHEAD)
+
+
+async def create_partitions(con, start, end):
+    """Creates the monthly partitions of mornings from start's month to end's."""
+    month = month_of(start)
+    while month <= end:
+        # dates are formatted by us, ddl can't take query parameters
+        await con.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+            f"PARTITION OF mornings FOR VALUES FROM ('{month}') TO "
+            f"('{next_month(month)}');"
+        )
+        month = next_month(month)
+
+
+async def partition_mornings(con):
+    """Converts mornings into a table partitioned by month, if it isn't already."""
+    if await is_partitioned(con):
+        return
+    async with con.transaction():
+        await con.execute("SELECT pg_advisory_xact_lock($1);", MIGRATION_LOCK)
+        if await is_partitioned(con):
+            return
+
+        print("partitioning mornings")
+        await con.execute(
+            """
+        ALTER TABLE mornings RENAME TO mornings_unpartitioned;
+        ALTER INDEX mornings_pkey RENAME TO mornings_unpartitioned_pkey;
+        ALTER INDEX mornings_date RENAME TO mornings_unpartitioned_date;
+        CREATE TABLE mornings (
+            mid BIGINT NOT NULL,
+            date DATE NOT NULL,
+            woke_up BOOLEAN NOT NULL DEFAULT false,
+            notified BOOLEAN NOT NULL DEFAULT false,
+            gid BIGINT NOT NULL,
+            FOREIGN KEY (gid, mid) REFERENCES members
+                ON DELETE CASCADE ON UPDATE CASCADE,
+            PRIMARY KEY (gid, mid, date)
+        ) PARTITION BY RANGE (date);
+        CREATE INDEX mornings_date ON mornings (date);
+        CREATE TABLE mornings_default PARTITION OF mornings DEFAULT;
+        """
+        )
+        today = current_datetime().date()
+        first = await con.fetchval("SELECT min(date) FROM mornings_unpartitioned;")
+        await create_partitions(con, first or today, partitions_ahead(today))
+        await con.execute(
+            """
+        INSERT INTO mornings SELECT * FROM mornings_unpartitioned;
+        DROP TABLE mornings_unpartitioned;
+        """
+        )
+
+
+class InvalidImport(Exception):
+    """Raised with the problems found in an import, nothing is imported."""
+
+    def __init__(self, errors):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+
+# what reading an import that isn't utf-8 csv raises, truncated gzip streams raise
+# EOFError and corrupt ones gzip.BadGzipFile, an OSError
+READ_ERRORS = (UnicodeDecodeError, csv.Error, OSError, EOFError)
+
+
+# the columns each table an import can load has to have, with the parser of each,
+# and the optional ones with their default
+IMPORTS = {
+    "members": (
+        {
+            "mid": parse_id,
+            "start_time": parse_time,
+            "end_time": parse_time,
+            "weekends": parse_bool,
+        },
+        {"tz": (parse_timezone, None)},
+    ),
+    "mornings": (
+        {"mid": parse_id, "date": parse_date, "woke_up": parse_bool},
+        # history from before is an outcome unless the file says otherwise
+        {"notified": (parse_bool, True)},
+    ),
+}
+
+
+async def import_csv(con, gid, lines, origin):
+    """Imports the members or the mornings in the csv lines into guild gid.
+
+    The header says which: members have start_time, mornings have date (so a
+    !data export imports as is). Rows are validated as they are streamed into a
+    staging table with COPY, then merged in one statement, all in one transaction.
+    Importing mornings recomputes the stats of their members. Returns the table,
+    how many rows were imported and how many skipped, and publishes a change to
+    the whole guild for the running instances. Raises InvalidImport if any row is
+    invalid.
+    """
+    reader = csv.reader(lines)
+    header = [name.strip() for name in next(reader, [])]
+    table = "mornings" if "date" in header else "members"
+    required, optional = IMPORTS[table]
+    missing = [name for name in required if name not in header]
+    if missing:
+        raise InvalidImport([f"the header is missing {', '.join(missing)}"])
+
+    parsers = [(header.index(name), parse) for name, parse in required.items()]
+    parsers += [
+        (header.index(name) if name in header else None, parse, default)
+        for name, (parse, default) in optional.items()
+    ]
+    today = current_datetime().date()
+    errors = []
+    staged = 0
+
+    def records():
+        nonlocal staged
+        for line, row in enumerate(reader, start=2):
+            if not row:
+                continue
+            try:
+                values = [gid]
+                for index, parse, *default in parsers:
+                    if index is None or index >= len(row) or not row[index].strip():
+                        if not default:
+                            raise ValueError(f"{header[index]} is missing")
+                        values.append(default[0])
+                    else:
+                        values.append(parse(row[index].strip()))
+                if table == "mornings" and values[2] > today:
+                    raise ValueError(f"{values[2]} is in the future")
+            except (ValueError, IndexError) as e:
+                if len(errors) < IMPORT_ERRORS:
+                    errors.append(f"line {line}: {e}")
+                continue
+            staged += 1
+            yield values
+
+    columns = ["gid", *required, *optional]
+    async with con.transaction():
+        await con.execute(
+            f"CREATE TEMP TABLE import_{table} (LIKE {table} INCLUDING DEFAULTS) "
+            "ON COMMIT DROP;"
+        )
+        await con.copy_records_to_table(
+            f"import_{table}", records=records(), columns=columns
+        )
+        if errors:
+            raise InvalidImport(errors)
+
+        if table == "members":
+            imported = len(await con.fetch(MERGE_MEMBERS))
+        else:
+            if await is_partitioned(con):
+                months = await con.fetch(
+                    "SELECT DISTINCT date_trunc('month', date)::date AS month "
+                    "FROM import_mornings;"
+                )
+                for row in months:
+                    await create_partitions(con, row["month"], row["month"])
+            merged = await con.fetch(MERGE_MORNINGS)
+            imported = sum(row["count"] for row in merged)
+            await con.execute(RECOMPUTE_STATS, gid, [row["mid"] for row in merged])
+
+        payload = json.dumps(
+            {"origin": origin, "table": "members", "gid": gid, "mid": None}
+        )
+        await con.execute("SELECT pg_notify($1, $2);", CHANGES_CHANNEL, payload)
+    return table, imported, staged - imported
+
+
+class Retention:
+    """Rolls mornings older than a horizon up into per member monthly summaries.
+
+    Expired rows are deleted, or moved into mornings_archive, in batches of at most
+    batch rows so the job never holds locks on mornings for long. When mornings is
+    partitioned it also creates the partitions for the coming months, and drops
+    whole expired partitions after rolling them up.
+    """
+
+    def __init__(self, pool, days, batch=RETENTION_BATCH, archive=False):
+        self.pool = pool
+        self.days = days
+        self.batch = batch
+        self.archive = archive
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        query_tag.set("retention")
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(RETENTION_INTERVAL)
+
+    async def sweep(self):
+        today = current_datetime().date()
+        horizon = today - datetime.timedelta(days=self.days) if self.days else None
+
+        async with self.pool.acquire() as con:
+            if await is_partitioned(con):
+                await create_partitions(con, today, partitions_ahead(today))
+                if horizon and not self.archive:
+                    await self.drop_partitions(con, horizon)
+        if not horizon:
+            return
+
+        query = ARCHIVE_MORNINGS if self.archive else ROLL_UP_MORNINGS
+        expired = self.batch
+        while expired == self.batch:
+            async with self.pool.acquire() as con:
+                expired = await con.fetchval(query, horizon, self.batch)
+            # give everything else a turn between batches
+            await asyncio.sleep(0)
+
+    async def drop_partitions(self, con, horizon):
+        """Rolls up and drops the partitions that are entirely before horizon."""
+        partitions = await con.fetch(
+            "SELECT relname FROM pg_inherits "
+            "JOIN pg_class ON pg_class.oid = pg_inherits.inhrelid "
+            "WHERE inhparent = 'mornings'::regclass;"
+        )
+        for partition in sorted(row["relname"] for row in partitions):
+            if partition == "mornings_default":
+                continue
+            month = datetime.datetime.strptime(partition, "mornings_%Y_%m").date()
+            if next_month(month) > horizon:
+                break
+            async with con.transaction():
+                await con.execute(
+                    f"WITH expired AS (SELECT * FROM {partition}),"
+                    + ROLL_UP_EXPIRED
+                    + f" SELECT 1; DROP TABLE {partition};"
+                )
+
+
+def pack_messages(messages, limit=DISCORD_MESSAGE_LIMIT):
+    """Joins messages with newlines into as few discord messages as possible."""
+    chunks = []
+    for message in messages:
+        for part in split_message(message, limit):
+            if chunks and len(chunks[-1]) + 1 + len(part) <= limit:
+                chunks[-1] += "\n" + part
+            else:
+                chunks.append(part)
+    return chunks
+
+
+class Outbox:
+    """Queues of outgoing messages, one per channel, each drained by a sender task
+    of its own.
+
+    Messages queued for the same channel within window seconds of each other are
+    coalesced into as few posts as possible. Every channel gets a rate limit bucket
+    that its sender waits on itself, so whatever queued a message (and whatever
+    database connection it holds) never waits on discord, and a burst to one
+    channel never holds up the messages of another.
+    """
+
+    def __init__(self, window=OUTBOX_WINDOW):
+        self.window = window
+        self.queues = {}
+        self.senders = {}
+        self.sent = {}
+        self.started = False
+
+    def __len__(self):
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    def post(self, channel, message):
+        # the text channel may not have been set yet
+        if channel is None:
+            print(f"dropped message, no channel to send it to: {message}")
+            return
+        queue = self.queues.get(channel.id)
+        if queue is None:
+            queue = self.queues[channel.id] = asyncio.Queue()
+        queue.put_nowait((channel, message))
+        if self.started and channel.id not in self.senders:
+            self.senders[channel.id] = asyncio.create_task(self.run(queue))
+
+    def start(self):
+        self.started = True
+        for id, queue in self.queues.items():
+            if id not in self.senders:
+                self.senders[id] = asyncio.create_task(self.run(queue))
+
+    def cancel(self):
+        self.started = False
+        for sender in self.senders.values():
+            sender.cancel()
+        self.senders.clear()
+
+    async def join(self):
+        """Waits until every queued message has been sent."""
+        for queue in list(self.queues.values()):
+            await queue.join()
+
+    async def run(self, queue):
+        while True:
+            channel, message = await queue.get()
+            messages = [message]
+            # let the rest of a burst catch up before posting
+            await asyncio.sleep(self.window)
+            while not queue.empty():
+                channel, message = queue.get_nowait()
+                messages.append(message)
+
+            try:
+                for message in pack_messages(messages):
+                    await self.send(channel, message)
+            finally:
+                for _ in messages:
+                    queue.task_done()
+
+    async def send(self, channel, message):
+        """Posts message to channel, retrying with backoff when it fails for a
+        reason that may pass. A post mentions a whole burst of members, so it
+        isn't given up on after a single 5xx, 429 or network error."""
+        backoff = SEND_BACKOFF
+        for attempt in range(1, SEND_ATTEMPTS + 1):
+            await self.wait_for_bucket(channel)
+            try:
+                await channel.send(message)
+                return
+            # discord errors and network errors alike, a failed post mustn't stop
+            # the sender
+            except Exception as e:
+                # missing permissions, a deleted channel... won't pass
+                permanent = (
+                    isinstance(e, discord.HTTPException)
+                    and e.status < 500
+                    and e.status != 429
+                )
+                if permanent or attempt == SEND_ATTEMPTS:
+                    traceback.print_exc()
+                    return
+                print(f"retrying a post to {channel.id} in {backoff}s: {e!r}")
+                await asyncio.sleep(backoff)
+                backoff *= 2
+
+    async def wait_for_bucket(self, channel):
+        """Waits until channel can take another message without being limited."""
+        sent = self.sent.get(channel.id)
+        if sent is None:
+            sent = self.sent[channel.id] = collections.deque(maxlen=CHANNEL_RATE)
+        if len(sent) == CHANNEL_RATE:
+            wait = sent[0] + CHANNEL_PERIOD - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        sent.append(time.monotonic())
+
+
+class JoinBatcher:
+    """Write-behind stage for voice joins.
+
+    Joins are collected for window seconds after the first one, deduplicated per
+    member and handed to flush(guild, joins, awake) once per guild and outcome,
+    with joins mapping each member to the date of their morning. A burst of
+    members joining at the start of a window becomes one upsert and one greeting.
+    """
+
+    def __init__(self, flush, window=JOIN_BATCH_WINDOW):
+        self.flush = flush
+        self.window = window
+        self.pending = {}
+        self.task = None
+
+    def __len__(self):
+        return sum(len(joins) for joins in self.pending.values())
+
+    def add(self, guild, mid, date, awake):
+        self.pending.setdefault((guild, awake), {})[mid] = date
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        await asyncio.sleep(self.window)
+        self.task = None
+        await self.write()
+
+    async def write(self):
+        pending, self.pending = self.pending, {}
+        for (guild, awake), joins in pending.items():
+            try:
+                await self.flush(guild, joins, awake)
+            except Exception:
+                traceback.print_exc()
+
+    async def drain(self):
+        """Writes every pending join now instead of at the end of the window."""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.write()
+
+
+class Histogram:
+    """Prometheus histogram of durations, with a series per set of label values."""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per bucket counts (the last one is +Inf), sum]
+        self.series = {}
+
+    def observe(self, seconds, *values):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total) in sorted(self.series.items()):
+            label = "".join(
+                f'{name}="{value}",' for name, value in zip(self.labels, values)
+            )
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label}le="{bound}"}} {cumulative}')
+            label = f"{{{label[:-1]}}}" if label else ""
+            lines.append(f"{self.name}_sum{label} {total}")
+            lines.append(f"{self.name}_count{label} {cumulative}")
+        return lines
+
+
+class Metrics:
+    """Serves metrics in the prometheus text format over a bare asyncio server.
+
+    Histograms are observed as things happen. Gauges and counters are callbacks
+    that read the current value off whatever they measure at scrape time, so
+    nothing has to be kept up to date in between scrapes.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.histograms = []
+        self.gauges = []
+        self.server = None
+        self.lag_task = None
+        self.lag = self.histogram(
+            "risengrind_event_loop_lag_seconds",
+            f"How late the event loop woke up from a {LAG_INTERVAL}s sleep",
+        )
+
+    def histogram(self, name, help, labels=()):
+        histogram = Histogram(name, help, labels)
+        self.histograms.append(histogram)
+        return histogram
+
+    def gauge(self, name, help, callback, label=None, type="gauge"):
+        """Registers callback as a gauge (or counter). callback returns the value,
+        a dict of label values to values when label is set, or None to skip it."""
+        self.gauges.append((name, help, callback, label, type))
+
+    def render(self):
+        lines = []
+        for name, help, callback, label, type in self.gauges:
+            values = callback()
+            if values is None:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            if label:
+                for value, number in values.items():
+                    lines.append(f'{name}{{{label}="{value}"}} {number}')
+            else:
+                lines.append(f"{name} {values}")
+        for histogram in self.histograms:
+            lines.extend(histogram.render())
+        return "\n".join(lines) + "\n"
+
+    async def start(self, port):
+        if self.server is None:
+            self.server = await asyncio.start_server(self.handle, port=port)
+            self.lag_task = asyncio.create_task(self.watch_loop())
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.lag_task.cancel()
+            self.server = None
+            self.lag_task = None
+
+    async def handle(self, reader, writer):
+        """Answers a single HTTP request and closes the connection."""
+        try:
+            request = (await reader.readline()).split()
+            # the headers don't matter, but have to be read before responding
+            while (await reader.readline()).strip():
+                pass
+            path = request[1].split(b"?")[0] if len(request) > 1 else b""
+            if path in (b"/", b"/metrics"):
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {self.CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (OSError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def watch_loop(self):
+        """Samples how long the loop takes to get back to a task after a sleep."""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lag.observe(max(loop.time() - start - LAG_INTERVAL, 0))
+
+
+class Rollback(Exception):
+    """Raised to roll back the transaction a query was explained in."""
+
+
+class InstrumentedConnection(asyncpg.Connection):
+    """Connection that logs EXPLAIN ANALYZE for a sampled fraction of queries.
+
+    A sampled query is explained in a transaction (or a savepoint, inside the
+    caller's transaction) that is always rolled back, then run as usual. Only
+    queries tagged with a command or listener are sampled, so session level side
+    effects like taking the leader lock never run twice.
+
+    Pool connections also prepare the hot path statements once, when they open.
+    """
+
+    explain_sample = 0
+
+    async def prepare_statements(self):
+        """Prepares the PREPARED statements into asyncpg's statement cache, the
+        same one fetch and execute look statements up in.
+
+        prepare() bypasses that cache, so this uses asyncpg's own lookup, which
+        is private. It matches asyncpg 0.29.0 as pinned in requirements.txt.
+        """
+        for query in PREPARED:
+            await self._get_statement(query, None)
+
+    async def explain(self, query, args):
+        if not self.explain_sample or not query_tag.get():
+            return
+        if random.random() >= self.explain_sample:
+            return
+        # only single data statements can be explained
+        query = query.strip().rstrip(";")
+        if ";" in query or query.split(None, 1)[0].upper() not in EXPLAINABLE:
+            return
+        try:
+            async with self.transaction():
+                plan = await super().fetch("EXPLAIN (ANALYZE, BUFFERS) " + query, *args)
+                raise Rollback
+        except Rollback:
+            logger.info(
+                "[%s] %s %r\n%s",
+                query_tag.get(),
+                query,
+                args,
+                "\n".join(row[0] for row in plan),
+            )
+        except asyncpg.PostgresError:
+            logger.exception("[%s] could not explain %s", query_tag.get(), query)
+
+    async def execute(self, query, *args, timeout=None):
+        await self.explain(query, args)
+        return await super().execute(query, *args, timeout=timeout)
+
+    async def fetch(self, query, *args, timeout=None, record_class=None):
+        await self.explain(query, args)
+        return await super().fetch(
+            query, *args, timeout=timeout, record_class=record_class
+        )
+
+    async def fetchrow(self, query, *args, timeout=None, record_class=None):
+        await self.explain(query, args)
+        return await super().fetchrow(
+            query, *args, timeout=timeout, record_class=record_class
+        )
+
+    async def fetchval(self, query, *args, column=0, timeout=None):
+        await self.explain(query, args)
+        return await super().fetchval(query, *args, column=column, timeout=timeout)
+
+
+class InstrumentedPool:
+    """Wraps a pool to time how long each caller waits for a connection.
+
+    Everything but acquiring is passed straight through to the pool, the queries
+    themselves are timed by the query logger on every connection.
+    """
+
+    def __init__(self, pool, wait):
+        self.pool = pool
+        self.wait = wait
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        start = time.monotonic()
+        async with self.pool.acquire() as con:
+            self.wait.observe(time.monotonic() - start, query_tag.get())
+            yield con
+
+    async def execute(self, query, *args, **kwargs):
+        async with self.acquire() as con:
+            return await con.execute(query, *args, **kwargs)
+
+    async def executemany(self, query, args, **kwargs):
+        async with self.acquire() as con:
+            return await con.executemany(query, args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        async with self.acquire() as con:
+            return await con.fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        async with self.acquire() as con:
+            return await con.fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        async with self.acquire() as con:
+            return await con.fetchval(query, *args, **kwargs)
+
+
+class Scheduler:
+    """Single timer for every member's end of window deadline.
+
+    Deadlines are kept in a heap so scheduling, rescheduling and removing a member
+    are O(log n). Removed entries are invalidated in place and skipped when they
+    reach the top of the heap. The timer wakes once per distinct deadline and hands
+    every member due at that deadline to callback(deadline, mids).
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = []
+        self.entries = {}
+        self.changed = asyncio.Event()
+        self.task = None
+        self.sweep = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, mid):
+        return mid in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def schedule(self, mid, deadline):
+        """Schedules mid at deadline, replacing any existing deadline for mid."""
+        self.remove(mid)
+        entry = [deadline, mid, True]
+        self.entries[mid] = entry
+        heapq.heappush(self.heap, entry)
+        # wake the timer up if this is the new earliest deadline
+        if self.heap[0] is entry:
+            self.changed.set()
+
+    def remove(self, mid):
+        """Removes mid from the schedule, returns False if it wasn't scheduled."""
+        entry = self.entries.pop(mid, None)
+        if entry is None:
+            return False
+        entry[-1] = False
+        # compact the heap once it's mostly invalidated entries
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [entry for entry in self.heap if entry[-1]]
+            heapq.heapify(self.heap)
+        return True
+
+    def peek(self):
+        """Returns the earliest deadline, or None if nothing is scheduled."""
+        while self.heap and not self.heap[0][-1]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop(self, deadline):
+        """Removes and returns every member due at deadline."""
+        mids = []
+        while self.heap and self.heap[0][0] == deadline:
+            _, mid, valid = heapq.heappop(self.heap)
+            if valid:
+                del self.entries[mid]
+                mids.append(mid)
+        return mids
+
+    def clear(self):
+        self.heap = []
+        self.entries = {}
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            self.changed.clear()
+            deadline = self.peek()
+            if deadline is None:
+                await self.changed.wait()
+                continue
+
+            seconds = (deadline - current_datetime()).total_seconds()
+            if seconds > 0:
+                # sleep until the deadline or until an earlier one is scheduled
+                try:
+                    await asyncio.wait_for(self.changed.wait(), seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            mids = self.pop(deadline)
+            # cancelling the scheduler doesn't interrupt a sweep that has started,
+            # close() waits for it instead
+            self.sweep = asyncio.create_task(self.callback(deadline, mids))
+            try:
+                await asyncio.shield(self.sweep)
+            except Exception:
+                traceback.print_exc()
+
+
+class Leadership:
+    """Elects one leader among the bot's replicas with a postgres advisory lock.
+
+    The leader holds pg_try_advisory_lock on a connection checked out of the pool
+    and pings it every interval. When that connection drops, postgres releases the
+    lock and the next replica to try takes over.
+    """
+
+    def __init__(self, pool, on_elected, on_deposed, key=LEADER_LOCK):
+        self.pool = pool
+        self.on_elected = on_elected
+        self.on_deposed = on_deposed
+        self.key = key
+        self.leader = False
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                async with self.pool.acquire() as con:
+                    if await con.fetchval("SELECT pg_try_advisory_lock($1);", self.key):
+                        await self.lead(con)
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(LEADER_INTERVAL)
+
+    async def lead(self, con):
+        self.leader = True
+        print(f"elected leader {current_datetime()}")
+        try:
+            await self.on_elected()
+            # the pings fail as soon as the connection holding the lock drops
+            while True:
+                await asyncio.sleep(LEADER_INTERVAL)
+                await con.fetchval("SELECT 1;")
+        finally:
+            self.leader = False
+            self.on_deposed()
+            print(f"deposed leader {current_datetime()}")
+
+
+class MemberCache:
+    """Write-through cache of the members table, keyed by mid.
+
+    The members table only changes through this bot's commands, so the cache is
+    loaded once on startup and then written to whenever those commands commit.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows.values())
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0
+        return (
+            f"members: {len(self)} cached, {self.hits} hits, {self.misses} misses "
+            f"({rate:.1%} hit rate)"
+        )
+
+    def load(self, rows):
+        self.rows = {row["mid"]: row for row in rows}
+
+    def get(self, mid):
+        row = self.rows.get(mid)
+        if row is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return row
+
+    def put(self, row):
+        self.rows[row["mid"]] = row
+
+    def pop(self, mid):
+        return self.rows.pop(mid, None)
+
+
+# a member's wake up window, dated by the local day it ends on. start, end and
+# deadline are UTC datetimes without a tzinfo
+Window = collections.namedtuple("Window", ("date", "start", "end", "deadline"))
+
+
+class Calendar:
+    """Works out members' wake up windows in UTC.
+
+    Windows follow the member's timezone (DEFAULT_TIMEZONE if they haven't set
+    one) through DST changes and skip weekends unless the member has opted into
+    them. ZoneInfo objects are cached by name, and every member's upcoming window
+    is cached until it closes or the member's settings change, so voice events and
+    the schedulers only look it up.
+    """
+
+    def __init__(self, default=DEFAULT_TIMEZONE):
+        self.default = default
+        self.zones = {}
+        self.windows = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return (
+            f"windows: {len(self.windows)} cached, {self.hits} hits, "
+            f"{self.misses} misses, {len(self.zones)} timezones"
+        )
+
+    def zone(self, name):
+        """Returns the ZoneInfo for name, or for the default timezone if name is
+        None. Raises ZoneInfoNotFoundError or ValueError for unknown names."""
+        name = name or self.default
+        zone = self.zones.get(name)
+        if zone is None:
+            zone = self.zones[name] = zoneinfo.ZoneInfo(name)
+        return zone
+
+    def next_window(self, member, now):
+        """Returns member's first window with a deadline at or after now."""
+        zone = self.zone(member["tz"])
+        start_time, end_time = member["start_time"], member["end_time"]
+        # the window ending yesterday may still be open when it crosses midnight
+        local = now.replace(tzinfo=datetime.timezone.utc).astimezone(zone)
+        date = local.date() - datetime.timedelta(days=1)
+        while True:
+            if member["weekends"] or not is_a_weekend(date):
+                # windows are read as widely as a daylight saving time change
+                # allows, so one never ends before it starts
+                end = to_utc(date, end_time, zone, latest=True)
+                if end + DEADLINE_GRACE >= now:
+                    start_date = date
+                    if start_time >= end_time:  # window crosses midnight
+                        start_date -= datetime.timedelta(days=1)
+                    start = to_utc(start_date, start_time, zone)
+                    return Window(date, start, end, end + DEADLINE_GRACE)
+            date += datetime.timedelta(days=1)
+
+    def window(self, gid, member, now):
+        """next_window, cached per member."""
+        key = (gid, member["mid"])
+        settings = (
+            member["start_time"],
+            member["end_time"],
+            member["weekends"],
+            member["tz"],
+        )
+        cached = self.windows.get(key)
+        if cached and cached[0] == settings and cached[1].deadline >= now:
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        window = self.next_window(member, now)
+        self.windows[key] = (settings, window)
+        return window
+
+    def forget(self, gid, mid=None):
+        """Drops the cached windows of mid, or of every member of gid."""
+        if mid is not None:
+            self.windows.pop((gid, mid), None)
+        else:
+            self.windows = {
+                key: value for key, value in self.windows.items() if key[0] != gid
+            }
+
+
+class NameCache:
+    """Bounded LRU of display names fetched from discord.
+
+    In lean gateway mode discord.py only caches members that are in a voice
+    channel, so everyone else is looked up on demand and kept here.
+    """
+
+    def __init__(self, size=NAME_CACHE_SIZE):
+        self.size = size
+        self.names = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def __str__(self):
+        return (
+            f"names: {len(self)}/{self.size} cached, {self.hits} hits, "
+            f"{self.misses} misses"
+        )
+
+    async def get(self, guild, mid):
+        member = guild.get_member(mid)
+        if member:
+            return member.display_name
+
+        key = (guild.id, mid)
+        name = self.names.get(key)
+        if name is not None:
+            self.hits += 1
+            self.names.move_to_end(key)
+            return name
+
+        self.misses += 1
+        try:
+            name = (await guild.fetch_member(mid)).display_name
+        except discord.HTTPException:
+            # left the guild, or discord is having a moment
+            name = str(mid)
+        self.names[key] = name
+        if len(self.names) > self.size:
+            self.names.popitem(last=False)
+        return name
+
+
+class GuildState:
+    """A guild's config, channels, members and end of window scheduler.
+
+    Every guild gets a scheduler of its own, so a burst of deadlines in one guild
+    never holds up another guild's notifications.
+    """
+
+    def __init__(self, guild, end_window):
+        self.guild = guild
+        self.id = guild.id
+        self.config = None
+        self.chat = None
+        self.voice = None
+        self.members = MemberCache()
+        self.scheduler = Scheduler(functools.partial(end_window, self))
+
+        # the (date, awake) each member's last join was written with, so rejoining
+        # the same morning doesn't write it again
+        self.settled = {}
+
+        # voice events are checked against these before doing any other work, they
+        # are rebuilt by rebuild_prefilter whenever the active members or the voice
+        # channel change
+        self.active = frozenset()
+        self.voice_id = None
+
+    def load_config(self, config):
+        """Loads chat and voice from config."""
+        self.config = config
+        self.chat = None
+        self.voice = None
+        if config["text_channel"]:
+            self.chat = self.guild.get_channel(config["text_channel"])
+        if config["voice_channel"]:
+            self.voice = self.guild.get_channel(config["voice_channel"])
+
+    def rebuild_prefilter(self):
+        """Rebuilds the voice event prefilter from the active members and channel."""
+        self.active = frozenset(
+            member["mid"] for member in self.members if member["active"]
+        )
+        self.voice_id = self.voice.id if self.voice else None
+
+
+class InfoPages(discord.ui.View):
+    """Previous and next buttons for !info.
+
+    Pages are keyset paginated by mid and fetched with fetch(after, number) only
+    when they're viewed, which returns the page's embed and the mid the next page
+    starts after (None on the last page).
+    """
+
+    def __init__(self, fetch, author, timeout=INFO_TIMEOUT):
+        super().__init__(timeout=timeout)
+        self.fetch = fetch
+        self.author = author
+        # the mid every page up to the current one starts after
+        self.starts = [0]
+        self.next_start = None
+        self.message = None
+
+    async def render(self):
+        embed, self.next_start = await self.fetch(self.starts[-1], len(self.starts))
+        self.previous.disabled = len(self.starts) == 1
+        self.next.disabled = self.next_start is None
+        return embed
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.author.id
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction, button):
+        self.starts.pop()
+        await interaction.response.edit_message(embed=await self.render(), view=self)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction, button):
+        self.starts.append(self.next_start)
+        await interaction.response.edit_message(embed=await self.render(), view=self)
+
+    async def on_timeout(self):
+        if self.message:
+            for item in self.children:
+                item.disabled = True
+            await self.message.edit(view=self)
+
+
 class RiseNGrind(commands.Cog):
-    def __init__(self, bot, guild_id, db_name, db_user, db_pass, db_host, db_port):
+    def __init__(
+        self,
+        bot,
+        guild_id,
+        db_name,
+        db_user,
+        db_pass,
+        db_host,
+        db_port,
+        leader_election=False,
+        retention_days=0,
+        retention_archive=False,
+        partitioned=False,
+        metrics_port=METRICS_PORT,
+        slow_query=SLOW_QUERY_SECONDS,
+        explain_sample=0,
+        pool_min_size=POOL_MIN_SIZE,
+        pool_max_size=POOL_MAX_SIZE,
+        pool_idle_lifetime=POOL_IDLE_LIFETIME,
+        statement_cache_size=STATEMENT_CACHE_SIZE,
+        pgbouncer=False,
+        replica_dsn=None,
+        timezone=DEFAULT_TIMEZONE,
+        join_batch_window=JOIN_BATCH_WINDOW,
+        shutdown_timeout=SHUTDOWN_TIMEOUT,
+    ):
         self.bot = bot
+        # the guild that adopts the rows from before there were guilds, if any
         self.guild_id = guild_id
         self.db_name = db_name
         self.db_user = db_user
         self.db_pass = db_pass
         self.db_host = db_host
         self.db_port = db_port
-
-        self.guild = None
-        self.chat = None
-        self.voice = None
+        self.leader_election = leader_election
+        self.retention_days = retention_days
+        self.retention_archive = retention_archive
+        self.partitioned = partitioned
+        self.metrics_port = metrics_port
+        self.slow_query = slow_query
+        self.explain_sample = explain_sample
+        self.pool_min_size = pool_min_size
+        self.pool_max_size = pool_max_size
+        self.pool_idle_lifetime = pool_idle_lifetime
+        # pgbouncer in transaction mode can't keep named prepared statements
+        self.statement_cache_size = 0 if pgbouncer else statement_cache_size
+        self.replica_dsn = replica_dsn
+        self.shutdown_timeout = shutdown_timeout
+        # identifies the changes this instance publishes so it can skip them
+        self.instance = uuid.uuid4().hex
+
+        self.guilds = {}
         self.db = None
-        self.loops = None
+        # read only commands query the replica, when there is one
+        self.reader = None
+        self.leading = False
+        self.leadership = None
+        self.retention = None
+        self.outbox = Outbox()
+        self.joins = JoinBatcher(self.write_joins, join_batch_window)
+        self.listener = None
+        self.listen_task = None
+        self.changes = asyncio.Lock()
+        # changes from other instances being applied, and the guilds whose changes
+        # failed to apply and need reloading
+        self.applying = set()
+        self.stale = set()
+        self.names = NameCache()
+        self.calendar = Calendar(timezone)
+        self.started = time.monotonic()
+        # seconds from starting to being ready, once ready
+        self.startup = None
+        # set once the schema is migrated, pool connections wait on it before
+        # preparing their statements
+        self.migrated = asyncio.Event()
+        # set by close(), new voice events and commands are turned away
+        self.closing = False
+        self.gateway_events = collections.Counter()
+        self.events_dropped = 0
+        self.events_processed = 0
+
+        self.metrics = Metrics()
+        self.command_latency = self.metrics.histogram(
+            "risengrind_command_seconds", "Time spent running commands", ("command",)
+        )
+        self.query_latency = self.metrics.histogram(
+            "risengrind_query_seconds", "Time spent on queries", ("tag", "statement")
+        )
+        self.pool_wait = self.metrics.histogram(
+            "risengrind_pool_wait_seconds",
+            "Time spent waiting for a database connection",
+            ("tag",),
+        )
+        self.metrics.gauge(
+            "risengrind_pool_connections",
+            "Database pool connections",
+            lambda: self.db
+            and {
+                "in_use": self.db.get_size() - self.db.get_idle_size(),
+                "idle": self.db.get_idle_size(),
+            },
+            label="state",
+        )
+        self.metrics.gauge(
+            "risengrind_replica_pool_connections",
+            "Read replica pool connections",
+            lambda: self.reader is not self.db
+            and {
+                "in_use": self.reader.get_size() - self.reader.get_idle_size(),
+                "idle": self.reader.get_idle_size(),
+            }
+            or None,
+            label="state",
+        )
+        self.metrics.gauge(
+            "risengrind_voice_events_total",
+            "Voice state updates received",
+            lambda: {
+                "processed": self.events_processed,
+                "dropped": self.events_dropped,
+            },
+            label="result",
+            type="counter",
+        )
+        self.metrics.gauge(
+            "risengrind_gateway_events_total",
+            "Gateway events received",
+            lambda: self.gateway_events,
+            label="type",
+            type="counter",
+        )
+        self.metrics.gauge(
+            "risengrind_max_rss_bytes",
+            "Peak resident memory",
+            max_rss,
+        )
+        self.metrics.gauge(
+            "risengrind_scheduled_members",
+            "Members waiting on an end of window deadline",
+            lambda: sum(len(guild.scheduler) for guild in self.guilds.values()),
+        )
+        self.metrics.gauge(
+            "risengrind_next_deadline_seconds",
+            "Seconds until the next end of window deadline",
+            self.seconds_to_deadline,
+        )
+        self.metrics.gauge(
+            "risengrind_outbox_messages",
+            "Messages waiting to be sent",
+            lambda: len(self.outbox),
+        )
+        self.metrics.gauge(
+            "risengrind_pending_joins",
+            "Voice joins waiting to be written",
+            lambda: len(self.joins),
+        )
+        self.metrics.gauge(
+            "risengrind_startup_seconds",
+            "Seconds from starting to being ready",
+            lambda: self.startup,
+        )
 
     @commands.Cog.listener()
     async def on_ready(self):
-        """Loads guild, chat, and voice. Attempts to infer voice and chat channels."""
+        """Loads every guild's config, members and channels."""
         # check if bot has already been initialized
-        if self.guild:
+        if self.db or self.closing:
             return
+        started = time.monotonic()
+
+        # none of these depend on each other, so they connect at the same time.
+        # the pools open their connections while the schema is migrated, and only
+        # prepare statements once it is. listening for other instances' changes
+        # starts before anything is loaded so none of them are missed
+        pools = [
+            self.create_pool(
+                database=self.db_name,
+                user=self.db_user,
+                password=self.db_pass,
+                host=self.db_host,
+                port=self.db_port,
+                init=self.init_connection,
+            )
+        ]
+        if self.replica_dsn:
+            pools.append(
+                self.create_pool(
+                    self.replica_dsn,
+                    init=functools.partial(self.init_connection, prepare=False),
+                )
+            )
+        _, self.listener, *pools = await asyncio.gather(
+            self.setup_schema(),
+            self.connect_listener(),
+            *pools,
+            *([self.metrics.start(self.metrics_port)] if self.metrics_port else []),
+        )
+        self.db = pools[0]
+        self.reader = pools[1] if self.replica_dsn else self.db
+
+        self.outbox.start()
+        self.listen_task = asyncio.create_task(self.listen())
+
+        if self.retention_days or self.partitioned:
+            self.retention = Retention(
+                self.db, self.retention_days, archive=self.retention_archive
+            )
+
+        # from here on the caches are the source of truth for members and config
+        schedules = await self.load_guilds(self.bot.guilds)
+
+        # every replica serves commands and voice events but only the leader runs
+        # the end of window scheduler
+        if self.leader_election:
+            self.leadership = Leadership(self.db, self.lead, self.unlead)
+            self.leadership.start()
+        else:
+            await self.lead(schedules)
 
-        # find the current guild
-        self.guild = find(lambda x: x.id == self.guild_id, self.bot.guilds)
+        now = time.monotonic()
+        self.startup = now - self.started
+        print(
+            f"ready {current_datetime()} in {self.startup:.2f}s "
+            f"({now - started:.2f}s after connecting to discord)"
+        )
+
+    async def setup_schema(self):
+        """Migrates the schema on a connection of its own, so the pool's
+        connections prepare their statements against the migrated schema."""
+        con = await self.connect()
+        try:
+            await migrate(con)
+            if self.guild_id:
+                await adopt_guild(con, self.guild_id)
+            if self.partitioned:
+                await partition_mornings(con)
+        finally:
+            await con.close()
+        self.migrated.set()
+
+    async def load_guilds(self, guilds):
+        """Loads the config, members and schedules of guilds, returns the
+        schedules."""
+        gids = [guild.id for guild in guilds]
+        async with self.changes:
+            row = await self.db.fetchrow(LOAD_GUILDS, gids)
+            for guild in guilds:
+                self.guilds[guild.id] = GuildState(guild, self.end_window)
+            self.load(gids, row["configs"], row["members"], row["schedules"])
+        return row["schedules"]
+
+    def load(self, gids, configs, members, schedules):
+        """Replaces the state of the guilds in gids with rows of configs, members
+        and schedules."""
+        rows = collections.defaultdict(list)
+        for row in members:
+            rows[row["gid"]].append(row)
+        for gid in gids:
+            self.guilds[gid].members.load(rows[gid])
+            self.guilds[gid].scheduler.clear()
+            # the mornings may have been rewritten too, e.g. by an import
+            self.guilds[gid].settled.clear()
+        for config in configs:
+            self.guilds[config["gid"]].load_config(config)
+        for schedule in schedules:
+            self.guilds[schedule["gid"]].scheduler.schedule(
+                schedule["mid"], schedule["deadline"]
+            )
+        for gid in gids:
+            self.guilds[gid].rebuild_prefilter()
+
+    def drop_member(self, guild, mid):
+        """Forgets everything about a member that was removed. Their mornings went
+        with them, so a join after they are added back has to be written again."""
+        guild.members.pop(mid)
+        guild.settled.pop(mid, None)
+        self.calendar.forget(guild.id, mid)
+
+    async def lead(self, schedules=None):
+        """Loads the persisted deadlines and starts the end of window schedulers.
+        On startup the schedules load_guilds just loaded are passed in, a leader
+        taking over later reads them again since the last one moved them on."""
+        # close every window that was missed while no instance was running, then
+        # pick up the persisted deadlines where they left off
+        now = current_datetime()
+        # the leader's own task goes on to hold the leader lock, leave it untagged
+        token = query_tag.set("lead")
+        try:
+            if schedules is None:
+                schedules = await self.db.fetch("SELECT * FROM schedules;")
+            deadlines = {}
+            mornings = []
+            advanced = []
+            for schedule in schedules:
+                gid, mid = schedule["gid"], schedule["mid"]
+                guild = self.guilds.get(gid)
+                if guild is None:
+                    continue
+                deadlines[gid, mid] = schedule["deadline"]
+                member = guild.members.get(mid)
+                if member is None or schedule["deadline"] > now:
+                    continue
+                # every window from the persisted deadline up to now was missed
+                window = self.calendar.next_window(member, schedule["deadline"])
+                while window.deadline <= now:
+                    mornings.append((gid, mid, window.date))
+                    window = self.calendar.next_window(
+                        member, window.deadline + datetime.timedelta(seconds=1)
+                    )
+                advanced.append((gid, mid, window.deadline))
+                deadlines[gid, mid] = window.deadline
+            missed = []
+            if advanced:
+                # the statement takes a column of values per parameter
+                missed = await self.db.fetch(
+                    CATCH_UP_MORNINGS,
+                    *(zip(*mornings) if mornings else ((), (), ())),
+                    *zip(*advanced),
+                    now,
+                )
+        finally:
+            query_tag.reset(token)
+        for guild in self.guilds.values():
+            guild.scheduler.clear()
+        for (gid, mid), deadline in deadlines.items():
+            self.guilds[gid].scheduler.schedule(mid, deadline)
+
+        # active members without a persisted deadline (i.e. activated before
+        # schedules existed) start from their next window
+        unscheduled = [
+            (
+                guild.id,
+                member["mid"],
+                self.calendar.window(guild.id, member, now).deadline,
+            )
+            for guild in self.guilds.values()
+            for member in guild.members
+            if member["active"] and member["mid"] not in guild.scheduler
+        ]
+        if unscheduled:
+            await self.db.executemany(
+                "INSERT INTO schedules (gid, mid, deadline) VALUES ($1, $2, $3) "
+                "ON CONFLICT (gid, mid) DO NOTHING;",
+                unscheduled,
+            )
+            for gid, mid, deadline in unscheduled:
+                self.guilds[gid].scheduler.schedule(mid, deadline)
+        self.leading = True
+        for guild in self.guilds.values():
+            guild.scheduler.start()
+        if self.retention:
+            self.retention.start()
+
+        sleepers = collections.defaultdict(set)
+        for row in missed:
+            sleepers[row["gid"]].add(row["mid"])
+        for gid, mids in sleepers.items():
+            if gid in self.guilds:
+                self.send_sleepers(self.guilds[gid], mids)
+
+    def unlead(self):
+        """Stops the jobs only the leader runs."""
+        self.leading = False
+        for guild in self.guilds.values():
+            guild.scheduler.cancel()
+        if self.retention:
+            self.retention.cancel()
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        await self.load_guilds([guild])
+        if self.leading:
+            self.guilds[guild.id].scheduler.start()
 
-        # database connector
-        self.db = await asyncpg.create_pool(
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.calendar.forget(guild.id)
+        guild = self.guilds.pop(guild.id, None)
+        if guild:
+            guild.scheduler.cancel()
+
+    async def close(self):
+        """Stops taking new voice events and commands, then lets the sweeps,
+        joins, transactions and messages in flight finish within
+        shutdown_timeout seconds before closing everything."""
+        if self.closing:
+            return
+        self.closing = True
+        started = time.monotonic()
+        deadline = started + self.shutdown_timeout
+        if self.leadership:
+            self.leadership.cancel()
+        if self.listen_task:
+            self.listen_task.cancel()
+        sweeps = [
+            guild.scheduler.sweep
+            for guild in self.guilds.values()
+            if guild.scheduler.sweep is not None
+        ]
+        self.unlead()
+        await self.drain(
+            "sweeps", deadline, asyncio.gather(*sweeps, return_exceptions=True)
+        )
+        await self.drain("joins", deadline, self.joins.drain())
+        # waits for the connections that are still in a transaction to be released
+        pools = [self.db] if self.db else []
+        if self.reader is not self.db:
+            pools.append(self.reader)
+        for pool in pools:
+            if not await self.drain("transactions", deadline, pool.close()):
+                pool.terminate()
+        await self.drain("messages", deadline, self.outbox.join())
+        self.outbox.cancel()
+        self.metrics.close()
+        if self.listener:
+            self.listener.terminate()
+        print(f"closed in {time.monotonic() - started:.2f}s")
+
+    async def drain(self, name, deadline, aw):
+        """Waits for aw until deadline, returns whether it finished in time. Once
+        the deadline has passed aw still gets to finish if it needn't wait."""
+        task = asyncio.ensure_future(aw)
+        done, _ = await asyncio.wait(
+            [task], timeout=max(deadline - time.monotonic(), 0)
+        )
+        if not done:
+            task.cancel()
+            print(f"gave up waiting for {name} after the shutdown timeout")
+            return False
+        if task.exception():
+            traceback.print_exception(task.exception())
+        return True
+
+    async def create_pool(self, dsn=None, **kwargs):
+        pool = await asyncpg.create_pool(
+            dsn,
+            min_size=self.pool_min_size,
+            max_size=self.pool_max_size,
+            max_inactive_connection_lifetime=self.pool_idle_lifetime,
+            statement_cache_size=self.statement_cache_size,
+            max_cached_statement_lifetime=STATEMENT_CACHE_LIFETIME,
+            connection_class=InstrumentedConnection,
+            **kwargs,
+        )
+        return InstrumentedPool(pool, self.pool_wait)
+
+    async def init_connection(self, con, prepare=True):
+        con.explain_sample = self.explain_sample
+        con.add_query_logger(self.log_query)
+        # the replica never runs the hot path writes
+        if prepare and self.statement_cache_size:
+            await self.migrated.wait()
+            await con.prepare_statements()
+
+    def log_query(self, record):
+        tag = query_tag.get()
+        statement = record.query.split(None, 1)[0].upper().rstrip(";")
+        self.query_latency.observe(record.elapsed, tag, statement)
+        if record.elapsed >= self.slow_query:
+            logger.warning(
+                "[%s] slow query (%.3fs): %s %r",
+                tag,
+                record.elapsed,
+                record.query.strip(),
+                record.args,
+            )
+
+    async def cog_check(self, ctx):
+        # every command works on the state of the guild it was sent in, and none
+        # start once shutting down
+        return (
+            not self.closing and ctx.guild is not None and ctx.guild.id in self.guilds
+        )
+
+    async def cog_before_invoke(self, ctx):
+        query_tag.set(ctx.command.qualified_name)
+        ctx.started = time.monotonic()
+
+    async def cog_after_invoke(self, ctx):
+        # runs even when the command raised
+        self.command_latency.observe(
+            time.monotonic() - ctx.started, ctx.command.qualified_name
+        )
+
+    def seconds_to_deadline(self):
+        deadlines = [guild.scheduler.peek() for guild in self.guilds.values()]
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        if not deadlines:
+            return None
+        return (min(deadlines) - current_datetime()).total_seconds()
+
+    async def connect(self):
+        """Opens a connection outside of the pool."""
+        return await asyncpg.connect(
             database=self.db_name,
             user=self.db_user,
             password=self.db_pass,
             host=self.db_host,
             port=self.db_port,
+            statement_cache_size=self.statement_cache_size,
         )
 
-        # TODO: add logger for the db stuff
-        # create tables if they don't exist
-        await self.db.execute(
-            """
-        CREATE TABLE IF NOT EXISTS members (
-            mid BIGINT NOT NULL,
-            start_time TIME(0) NOT NULL,
-            end_time TIME(0) NOT NULL,
-            weekends BOOLEAN NOT NULL,
-            active BOOLEAN NOT NULL DEFAULT false,
-            PRIMARY KEY (mid)
-        );
-        """
-        )
-        await self.db.execute(
-            """
-        CREATE TABLE IF NOT EXISTS mornings (
-            mid BIGINT NOT NULL,
-            date DATE NOT NULL,
-            woke_up BOOLEAN NOT NULL DEFAULT false,
-            notified BOOLEAN NOT NULL DEFAULT false,
-            FOREIGN KEY (mid) REFERENCES members ON DELETE CASCADE,
-            PRIMARY KEY (mid, date)
-        );
-        """
-        )
-        await self.db.execute(
-            """
-        CREATE TABLE IF NOT EXISTS configs (
-            cid INTEGER NOT NULL,
-            text_channel BIGINT,
-            voice_channel BIGINT,
-            PRIMARY KEY (cid)
-        );
-        """
+    async def connect_listener(self):
+        """Opens a connection outside of the pool that listens for changes."""
+        con = await self.connect()
+        await con.add_listener(CHANGES_CHANNEL, self.on_change)
+        return con
+
+    async def listen(self):
+        """Keeps the listening connection alive, reconnecting if it drops."""
+        while True:
+            try:
+                if self.listener is None or self.listener.is_closed():
+                    self.listener = await self.connect_listener()
+                    # anything published while disconnected was missed
+                    await self.reload()
+                await asyncio.sleep(LISTEN_INTERVAL)
+                await self.listener.execute("SELECT 1;")
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                traceback.print_exc()
+                if self.listener is not None:
+                    self.listener.terminate()
+                    self.listener = None
+                await asyncio.sleep(LISTEN_INTERVAL)
+                continue
+            await self.reload_stale()
+
+    async def reload_stale(self):
+        """Reloads the guilds whose changes failed to apply, keeping them stale
+        until that works."""
+        if not self.stale:
+            return
+        gids = self.stale
+        self.stale = set()
+        try:
+            await self.reload(gids)
+        except Exception:
+            traceback.print_exc()
+            self.stale |= gids
+
+    async def publish(self, con, table, gid, mid=None):
+        """Publishes a change to table, sent once con's transaction commits."""
+        payload = json.dumps(
+            {"origin": self.instance, "table": table, "gid": gid, "mid": mid}
         )
+        await con.execute("SELECT pg_notify($1, $2);", CHANGES_CHANNEL, payload)
+
+    def on_change(self, con, pid, channel, payload):
+        change = json.loads(payload)
+        if change["origin"] != self.instance:
+            task = asyncio.create_task(self.apply_change(change))
+            self.applying.add(task)
+            task.add_done_callback(functools.partial(self.applied, change["gid"]))
+
+    def applied(self, gid, task):
+        self.applying.discard(task)
+        if not task.cancelled() and task.exception():
+            traceback.print_exception(task.exception())
+            # the change is lost, the whole guild is reloaded on the next check
+            self.stale.add(gid)
+
+    async def apply_change(self, change):
+        """Applies a change published by another instance to the local state."""
+        if change["table"] == "members" and change["mid"] is None:
+            # an import changed the whole guild
+            await self.reload([change["gid"]])
+            return
+        query_tag.set("apply_change")
+        # changes are applied one at a time, in the order they were committed
+        async with self.changes:
+            guild = self.guilds.get(change["gid"])
+            if guild is None:
+                return
+            async with self.db.acquire() as con:
+                if change["table"] == "configs":
+                    guild.load_config(
+                        await con.fetchrow(
+                            "SELECT * FROM configs WHERE gid = $1;", guild.id
+                        )
+                    )
+                else:
+                    mid = change["mid"]
+                    data = await con.fetchrow(
+                        "SELECT * FROM members WHERE gid = $1 AND mid = $2;",
+                        guild.id,
+                        mid,
+                    )
+                    schedule = await con.fetchrow(
+                        "SELECT * FROM schedules WHERE gid = $1 AND mid = $2;",
+                        guild.id,
+                        mid,
+                    )
+                    if data:
+                        guild.members.put(data)
+                    else:
+                        self.drop_member(guild, mid)
+                    if schedule:
+                        guild.scheduler.schedule(mid, schedule["deadline"])
+                    else:
+                        guild.scheduler.remove(mid)
+            guild.rebuild_prefilter()
+
+    async def reload(self, gids=None):
+        """Reloads the members, config and schedules of the guilds in gids (every
+        guild by default) from the database."""
+        query_tag.set("reload")
+        async with self.changes:
+            gids = [gid for gid in gids or self.guilds if gid in self.guilds]
+            if not gids:
+                return
+            row = await self.db.fetchrow(LOAD_GUILDS, gids)
+            self.load(gids, row["configs"], row["members"], row["schedules"])
+
+    async def check_timezone(self, ctx, timezone):
+        """Returns whether timezone is None or a known timezone, telling ctx if
+        it isn't."""
+        if timezone is None:
+            return True
+        try:
+            self.calendar.zone(timezone)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            await ctx.channel.send(
+                f"unknown timezone {timezone}, use a name like America/New_York"
+            )
+            return False
+        return True
 
-        self.chat = None
-        self.voice = None
+    async def display_names(self, guild, mids):
+        return await asyncio.gather(*(self.names.get(guild.guild, mid) for mid in mids))
 
-        config = await self.db.fetchrow("SELECT * FROM configs WHERE cid = 0;")
-        if not config:  # create blank config entry if it does not exists
-            await self.db.execute("""INSERT INTO configs (cid) values (0);""")
-        else:  # otherwise load from config
-            if config["text_channel"]:
-                self.chat = find(
-                    lambda x: x.id == config["text_channel"], self.guild.channels
-                )
-            if config["voice_channel"]:
-                self.voice = find(
-                    lambda x: x.id == config["voice_channel"], self.guild.channels
-                )
+    async def cog_load(self):
+        # count gateway events as they are dispatched, a listener would have
+        # discord.py start a task for every one of them just to bump a counter
+        dispatch = self.bot.dispatch
 
-        self.loops = {}
-        members = await self.db.fetch("SELECT * FROM members;")
-        for member in members:
-            if member["active"]:
-                user = self.bot.get_user(member["mid"])
-                task = tasks.loop(count=1)(self.notify)
-                self.loops[user] = task
-                task.start(user, member)
+        def count_events(event, *args, **kwargs):
+            if event == "socket_event_type":
+                self.gateway_events[args[0]] += 1
+            dispatch(event, *args, **kwargs)
 
-        print(f"ready {current_datetime()}")
+        self.bot.dispatch = count_events
 
-    async def close(self):
-        """Closes bot stuff"""
-        for loop in self.loops.values():
-            loop.cancel()
-        await self.db.close()
+    async def cog_unload(self):
+        # back to the bot's own dispatch
+        del self.bot.dispatch
 
     @commands.command(brief="Shuts down the bot")
     async def shutdown(self, ctx):
@@ -198,110 +2477,107 @@ class RiseNGrind(commands.Cog):
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, user, before, after):
-        today = current_datetime()
-        # if not a voice join event
-        if not (before.channel is None and after.channel is not None):
-            return
-        # if not the voice channel we care about
-        if after.channel != self.voice:
+        # most voice events are mutes, deafens and streams or come from users we
+        # don't track, so reject them with set and id lookups before anything else
+        guild = self.guilds.get(user.guild.id)
+        if (
+            # if not a guild we've loaded, or shutting down
+            guild is None
+            or self.closing
+            # if user has not been activated
+            or user.id not in guild.active
+            # if not a voice join event
+            or before.channel is not None
+            or after.channel is None
+            # if not the voice channel we care about
+            or after.channel.id != guild.voice_id
+        ):
+            self.events_dropped += 1
             return
-        # if user has not been activated
-        if user not in self.loops:
+        self.events_processed += 1
+        query_tag.set("on_voice_state_update")
+
+        now = current_datetime()
+        data = guild.members.get(user.id)
+        if not data:
             return
 
+        # joining during the window wakes the member up, joining any other time
+        # just makes sure the next window's row exists
+        window = self.calendar.window(guild.id, data, now)
+        awake = window.start <= now <= window.end
+        if guild.settled.get(user.id) != (window.date, awake):
+            self.joins.add(guild, user.id, window.date, awake)
+
+    async def write_joins(self, guild, joins, awake):
+        """Writes a batch of guild's voice joins and greets everyone that woke up."""
+        query_tag.set("write_joins")
+        mids = list(joins)
         async with self.db.acquire() as con:
-            data = await con.fetchrow("SELECT * FROM members WHERE mid = $1;", user.id)
-            if not data:
-                return
-
-            morning = await con.fetchrow(
-                "SELECT * FROM mornings WHERE mid=$1 AND date=$2",
-                user.id,
-                today,
-            )
-            if not morning:
-                async with con.transaction():
-                    await con.execute(
-                        "INSERT INTO mornings (mid, date) VALUES ($1, $2);",
-                        user.id,
-                        today,
-                    )
-                    morning = await con.fetchrow(
-                        "SELECT * FROM mornings WHERE mid=$1 AND date=$2",
-                        user.id,
-                        today,
-                    )
-
-            if (
-                in_time_range(data["start_time"], current_time(), data["end_time"])
-                and not morning["notified"]
-                and not morning["woke_up"]
-            ):
-                async with con.transaction():
-                    await con.execute(
-                        "UPDATE mornings SET woke_up=true, notified=true "
-                        "WHERE mid=$1 AND date=$2;",
-                        user.id,
-                        today,
-                    )
-                mess = get_random_message(awake_messages, user.mention)
-                await self.chat.send(mess)
-
-    async def notify(self, user, data):
-        """Main notify logic."""
-        # TODO: add weekend logic
-        while True:
-            today = current_datetime()
-            # wait until tomorrow at end time, I should probably unit test this ...
-            # number of seconds from midnight to end time
-            diff = (
-                datetime.datetime.combine(datetime.date.min, data["end_time"])
-                - datetime.datetime.min
+            rows = await con.fetch(
+                UPSERT_MORNINGS,
+                guild.id,
+                mids,
+                [joins[mid] for mid in mids],
+                awake,
+                awake,
             )
-            # datetime of tomorrow at end_time (+ 10 seconds for good measure)
-            tmrw = (
-                today.replace(hour=0, minute=0, second=0, microsecond=0)
-                + diff
-                + datetime.timedelta(days=1, seconds=10)
+        for mid in mids:
+            guild.settled[mid] = (joins[mid], awake)
+
+        woke_up = [row["mid"] for row in rows if row["notified"]]
+        if woke_up:
+            mentions = " ".join(mention(mid) for mid in woke_up)
+            mess = get_random_message(awake_messages, mentions)
+            self.outbox.post(guild.chat, mess)
+
+    async def end_window(self, guild, deadline, mids):
+        """Called by guild's scheduler once the windows ending at deadline have
+        closed."""
+        query_tag.set("end_window")
+        # joins still waiting to be written would otherwise be swept as missed
+        await self.joins.drain()
+        closed, dates, nexts = [], [], []
+        after = deadline + datetime.timedelta(seconds=1)
+        # schedule the next window before sweeping so a failure below doesn't
+        # drop the member from the schedule. members removed or deactivated while
+        # the joins were drained aren't scheduled again
+        for mid in mids:
+            member = guild.members.get(mid)
+            if member is None or not member["active"]:
+                continue
+            window = self.calendar.window(guild.id, member, deadline)
+            # a deadline from before the member's settings changed isn't a window
+            # that closed, just move on to the next one
+            if window.deadline == deadline:
+                closed.append(mid)
+                dates.append(window.date)
+                window = self.calendar.window(guild.id, member, after)
+                nexts.append(window.deadline)
+            guild.scheduler.schedule(mid, window.deadline)
+        if closed:
+            await self.notify(guild, closed, deadline, dates, nexts)
+
+    async def notify(self, guild, mids, deadline, dates, nexts):
+        """Main notify logic.
+
+        Sweeps every member whose window closed at deadline in a single statement,
+        marking the morning in dates and moving their deadline to the one in nexts,
+        and sends one message mentioning everyone that slept in.
+        """
+        async with self.db.acquire() as con:
+            sleepers = await con.fetch(
+                SWEEP_MORNINGS, guild.id, mids, dates, False, True, deadline, nexts
             )
-            # number of seconds between tmrw and today
-            seconds = (tmrw - today).total_seconds()
-            if seconds > 0:
-                await asyncio.sleep(seconds)
 
-            # NOTE: since the process has been slept for about a day, tmrw is going to be
-            # the current date most likely, unless end_time is very close to midnight
-            # in which case tmrw may be the previous day in which case we have to
-            # use that date when updating mornings
-            async with self.db.acquire() as con:
-                morning = await con.fetchrow(
-                    "SELECT * FROM mornings WHERE mid=$1 AND date=$2",
-                    user.id,
-                    tmrw,
-                )
-                if not morning:
-                    async with con.transaction():
-                        await con.execute(
-                            "INSERT INTO mornings (mid, date) VALUES ($1, $2);",
-                            user.id,
-                            tmrw,
-                        )
-                        morning = await con.fetchrow(
-                            "SELECT * FROM mornings WHERE mid=$1 AND date=$2",
-                            user.id,
-                            tmrw,
-                        )
+        # if they haven't woke up, send a passive aggressive message
+        if sleepers:
+            self.send_sleepers(guild, [row["mid"] for row in sleepers])
 
-                # if they haven't woke up, send a passive aggressive message
-                if not morning["notified"]:
-                    async with con.transaction():
-                        await con.execute(
-                            "UPDATE mornings SET notified=true WHERE mid=$1 AND date=$2;",
-                            user.id,
-                            tmrw,
-                        )
-                    mess = get_random_message(sleep_messages, user.mention)
-                    await self.chat.send(mess)
+    def send_sleepers(self, guild, mids):
+        mentions = " ".join(mention(mid) for mid in mids)
+        mess = get_random_message(sleep_messages, mentions)
+        self.outbox.post(guild.chat, mess)
 
     @commands.command(brief="Activate tracking for a user")
     async def activate(self, ctx, user: discord.Member):
@@ -311,27 +2587,37 @@ class RiseNGrind(commands.Cog):
         --------
         !activate @janedoe
         """
-        async with self.db.acquire() as con:
-            data = await con.fetchrow("SELECT * FROM members WHERE mid = $1;", user.id)
-
+        guild = self.guilds[ctx.guild.id]
+        data = guild.members.get(user.id)
         if not data:
             await ctx.channel.send(f"{user.display_name} is not a member")
             return
 
-        if user in self.loops:
+        if data["active"]:
             await ctx.channel.send(f"{user.display_name} is already active")
             return
 
-        task = tasks.loop(count=1)(self.notify)
-        self.loops[user] = task
-        task.start(user, data)
+        deadline = self.calendar.window(guild.id, data, current_datetime()).deadline
+        guild.scheduler.schedule(user.id, deadline)
 
         async with self.db.acquire() as con:
             async with con.transaction():
+                data = await con.fetchrow(
+                    "UPDATE members SET active=true "
+                    "WHERE gid=$1 AND mid=$2 RETURNING *;",
+                    guild.id,
+                    user.id,
+                )
                 await con.execute(
-                    "UPDATE members SET active=true WHERE mid=$1;",
+                    "INSERT INTO schedules (gid, mid, deadline) VALUES ($1, $2, $3) "
+                    "ON CONFLICT (gid, mid) DO UPDATE SET deadline = EXCLUDED.deadline;",
+                    guild.id,
                     user.id,
+                    deadline,
                 )
+                await self.publish(con, "members", guild.id, user.id)
+            guild.members.put(data)
+        guild.rebuild_prefilter()
 
         await ctx.channel.send(f"{user.display_name} is now active")
 
@@ -343,59 +2629,117 @@ class RiseNGrind(commands.Cog):
         --------
         !deactivate @janedoe
         """
-        async with self.db.acquire() as con:
-            data = await con.fetchrow("SELECT * FROM members WHERE mid = $1;", user.id)
-
+        guild = self.guilds[ctx.guild.id]
+        data = guild.members.get(user.id)
         if not data:
             await ctx.channel.send(f"{user.display_name} is not a member")
             return
 
-        if user not in self.loops:
+        if not data["active"]:
             await ctx.channel.send(f"{user.display_name} is already inactive")
             return
 
-        self.loops[user].cancel()
-        del self.loops[user]
+        guild.scheduler.remove(user.id)
 
         async with self.db.acquire() as con:
             async with con.transaction():
-                await con.execute(
-                    "UPDATE members SET active=false WHERE mid=$1;",
+                data = await con.fetchrow(
+                    "UPDATE members SET active=false "
+                    "WHERE gid=$1 AND mid=$2 RETURNING *;",
+                    guild.id,
                     user.id,
                 )
+                await con.execute(
+                    "DELETE FROM schedules WHERE gid=$1 AND mid=$2;", guild.id, user.id
+                )
+                await self.publish(con, "members", guild.id, user.id)
+            guild.members.put(data)
+        guild.rebuild_prefilter()
 
         await ctx.channel.send(f"{user.display_name} has been deactivated")
 
     @commands.command(brief="Fetch mornings data")
-    async def data(self, ctx, verbose: bool = None):
+    async def data(
+        self,
+        ctx,
+        verbose: bool = None,
+        start: Optional[parse_date] = None,
+        end: Optional[parse_date] = None,
+        user: Optional[discord.Member] = None,
+        compress: bool = False,
+    ):
         """Fetch mornings data
         Usage
         -----
-        !data <send_as_message (optional)>
+        !data <send_as_message (optional)> <start (optional)> <end (optional)>
+              <user (optional)> <gzip (optional)>
+
+        If send as message is set, (yes/t/y/true), then the data is sent as
+        messages
 
-        If send as message is set, (yes/t/y/true), then the data is sent as a
-        message
+        If it is not set, the data is sent as a csv file, gzipped if gzip is set
 
-        If it is not set, the data is sent as a csv file
+        start and end (YYYY-MM-DD, inclusive) and user only export the matching
+        mornings
 
         Examples
         --------
         !data
 
         !data yes
+
+        !data no 2024-01-01 2024-01-31
+
+        !data no @janedoe yes
         """
-        async with self.db.acquire() as con:
-            await con.copy_from_query(
-                "SELECT * FROM mornings",
-                output="data.csv",
-                format="csv",
-                header=True,
-            )
-        if verbose:
-            with open("data.csv") as fi:
-                await ctx.channel.send(fi.read())
-        else:
-            await ctx.channel.send(file=discord.File("data.csv"))
+        guild = self.guilds[ctx.guild.id]
+        # filters are pushed down into the query so only matching rows are copied
+        filters, args = ["gid = $1"], [guild.id]
+        if start:
+            args.append(start)
+            filters.append(f"date >= ${len(args)}")
+        if end:
+            args.append(end)
+            filters.append(f"date <= ${len(args)}")
+        if user:
+            args.append(user.id)
+            filters.append(f"mid = ${len(args)}")
+        query = "SELECT * FROM mornings WHERE " + " AND ".join(filters)
+        query += " ORDER BY date, mid"
+
+        compress = compress and not verbose
+        with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as buffer:
+            # stream the copy straight into the buffer instead of a file on disk
+            sink = gzip.GzipFile(fileobj=buffer, mode="wb") if compress else buffer
+
+            async def write(chunk):
+                sink.write(chunk)
+
+            async with self.reader.acquire() as con:
+                await con.copy_from_query(
+                    query,
+                    *args,
+                    output=write,
+                    format="csv",
+                    header=True,
+                )
+            if compress:
+                sink.close()
+            buffer.seek(0)
+
+            if verbose:
+                # send the csv a message sized chunk of lines at a time
+                message = ""
+                for line in io.TextIOWrapper(buffer, encoding="utf-8"):
+                    if len(message) + len(line) > DISCORD_MESSAGE_LIMIT:
+                        await ctx.channel.send(message)
+                        message = ""
+                    message += line
+                if message:
+                    await ctx.channel.send(message)
+            else:
+                filename = "data.csv.gz" if compress else "data.csv"
+                await ctx.channel.send(file=discord.File(buffer, filename=filename))
 
     @commands.command(brief="Add user to the morning club")
     async def add(
@@ -405,44 +2749,94 @@ class RiseNGrind(commands.Cog):
         start_time: str,
         end_time: str,
         weekends: bool,
+        timezone: Optional[str] = None,
     ):
-        """Adds user to the morning club
+        """Adds user to the morning club, in the bot's default timezone unless one
+        is given
 
         Examples
         --------
         !add @janedoe 06:30:00 7:00:00 yes
         !add @janedoe 12:00:00 13:00:00 no
+        !add @janedoe 06:30:00 7:00:00 no America/New_York
         """
-        async with self.db.acquire() as con:
-            _exists = await con.fetchrow(
-                "SELECT * FROM members WHERE mid = $1;", user.id
+        guild = self.guilds[ctx.guild.id]
+        if guild.members.get(user.id):
+            await ctx.channel.send(
+                f"{user.display_name} is already in the club, please use the "
+                "update command instead"
             )
-            if _exists:
-                await ctx.channel.send(
-                    f"{user.display_name} is already in the club, please use the "
-                    "update command instead"
-                )
-                return
+            return
 
-            try:
-                start_time = datetime.datetime.strptime(start_time, "%H:%M:%S").time()
-                end_time = datetime.datetime.strptime(end_time, "%H:%M:%S").time()
-            except ValueError as e:
-                await ctx.channel.send(e)
-                return
+        try:
+            start_time = datetime.datetime.strptime(start_time, "%H:%M:%S").time()
+            end_time = datetime.datetime.strptime(end_time, "%H:%M:%S").time()
+        except ValueError as e:
+            await ctx.channel.send(e)
+            return
+        if not await self.check_timezone(ctx, timezone):
+            return
 
+        async with self.db.acquire() as con:
             async with con.transaction():
-                await con.execute(
+                data = await con.fetchrow(
                     "INSERT INTO members "
-                    "(mid, start_time, end_time, weekends) "
-                    "VALUES ($1, $2, $3, $4);",
+                    "(gid, mid, start_time, end_time, weekends, tz) "
+                    "VALUES ($1, $2, $3, $4, $5, $6) RETURNING *;",
+                    guild.id,
                     user.id,
                     start_time,
                     end_time,
                     weekends,
+                    timezone,
                 )
+                await self.publish(con, "members", guild.id, user.id)
+            guild.members.put(data)
         await ctx.channel.send(f"Welcome to the club {user.display_name}!")
 
+    @commands.command(name="import", brief="Import members or mornings from a csv")
+    async def import_(self, ctx):
+        """Import members or mornings from an attached csv (or csv.gz)
+
+        Members need mid, start_time, end_time and weekends columns and can have a
+        tz column, members that are already in the club are updated unless they are
+        active. Mornings need mid, date and woke_up columns and can have a notified
+        column, so the file !data sends imports as is. Nothing is imported if a row
+        is invalid.
+
+        Examples
+        --------
+        !import (with members.csv attached)
+
+        !import (with data.csv.gz attached)
+        """
+        guild = self.guilds[ctx.guild.id]
+        if not ctx.message.attachments:
+            await ctx.channel.send("please attach a csv to import")
+            return
+
+        for attachment in ctx.message.attachments:
+            started = time.monotonic()
+            buffer = io.BytesIO(await attachment.read())
+            if attachment.filename.endswith(".gz"):
+                buffer = gzip.GzipFile(fileobj=buffer, mode="rb")
+            lines = io.TextIOWrapper(buffer, encoding="utf-8", newline="")
+            try:
+                async with self.db.acquire() as con:
+                    table, imported, skipped = await import_csv(
+                        con, guild.id, lines, self.instance
+                    )
+            except (InvalidImport, *READ_ERRORS) as e:
+                await ctx.channel.send(f"nothing imported from {attachment.filename}:")
+                for message in pack_messages(str(e).splitlines()):
+                    await ctx.channel.send(message)
+                continue
+            await self.reload([guild.id])
+            await ctx.channel.send(
+                f"imported {imported} {table} from {attachment.filename} "
+                f"({skipped} skipped) in {time.monotonic() - started:.2f}s"
+            )
+
     @commands.command(brief="Remove user from the morning club")
     async def remove(self, ctx, user: discord.Member):
         """Remove user from the morning club
@@ -451,25 +2845,27 @@ class RiseNGrind(commands.Cog):
         --------
         !remove @janedoe
         """
-        async with self.db.acquire() as con:
-            _exists = await con.fetchrow(
-                "SELECT * FROM members WHERE mid = $1;", user.id
-            )
-            if not _exists:
-                await ctx.channel.send(f"{user.display_name} is not a member")
-                return
+        guild = self.guilds[ctx.guild.id]
+        data = guild.members.get(user.id)
+        if not data:
+            await ctx.channel.send(f"{user.display_name} is not a member")
+            return
 
-            if user in self.loops:
-                await ctx.channel.send(
-                    f"please deactivate {user.display_name}  before removing"
-                )
-                return
+        if data["active"]:
+            await ctx.channel.send(
+                f"please deactivate {user.display_name}  before removing"
+            )
+            return
 
+        async with self.db.acquire() as con:
             async with con.transaction():
                 await con.execute(
-                    "DELETE FROM members WHERE mid = $1;",
+                    "DELETE FROM members WHERE gid = $1 AND mid = $2;",
+                    guild.id,
                     user.id,
                 )
+                await self.publish(con, "members", guild.id, user.id)
+            self.drop_member(guild, user.id)
 
         await ctx.channel.send(f"{user.display_name} left the club ;(")
 
@@ -481,51 +2877,60 @@ class RiseNGrind(commands.Cog):
         start_time: str,
         end_time: str,
         weekends: bool,
+        timezone: Optional[str] = None,
     ):
-        """Update user settings
+        """Update user settings, the timezone is left as it is unless one is given
 
         Examples
         --------
         !update @janedoe 06:30:00 7:00:00 yes
         !update @janedoe 12:00:00 13:00:00 no
+        !update @janedoe 06:30:00 7:00:00 no Europe/London
         """
-        async with self.db.acquire() as con:
-            _exists = await con.fetchrow(
-                "SELECT * FROM members WHERE mid = $1;", user.id
-            )
-            if not _exists:
-                await ctx.channel.send(f"{user.display_name} is not a member")
-                return
+        guild = self.guilds[ctx.guild.id]
+        data = guild.members.get(user.id)
+        if not data:
+            await ctx.channel.send(f"{user.display_name} is not a member")
+            return
 
-            if user in self.loops:
-                await ctx.channel.send(
-                    f"please deactivate {user.display_name} before updating"
-                )
-                return
+        if data["active"]:
+            await ctx.channel.send(
+                f"please deactivate {user.display_name} before updating"
+            )
+            return
 
-            try:
-                start_time = datetime.datetime.strptime(start_time, "%H:%M:%S").time()
-                end_time = datetime.datetime.strptime(end_time, "%H:%M:%S").time()
-            except ValueError as e:
-                await ctx.channel.send(e)
-                return
+        try:
+            start_time = datetime.datetime.strptime(start_time, "%H:%M:%S").time()
+            end_time = datetime.datetime.strptime(end_time, "%H:%M:%S").time()
+        except ValueError as e:
+            await ctx.channel.send(e)
+            return
+        if not await self.check_timezone(ctx, timezone):
+            return
 
+        async with self.db.acquire() as con:
             async with con.transaction():
-                await con.execute(
+                data = await con.fetchrow(
                     "UPDATE members "
-                    "SET start_time=$1, end_time=$2, weekends=$3 "
-                    "WHERE mid = $4;",
+                    "SET start_time=$1, end_time=$2, weekends=$3, "
+                    "tz=coalesce($6, tz) "
+                    "WHERE gid = $4 AND mid = $5 RETURNING *;",
                     start_time,
                     end_time,
                     weekends,
+                    guild.id,
                     user.id,
+                    timezone,
                 )
+                await self.publish(con, "members", guild.id, user.id)
+            guild.members.put(data)
 
         await ctx.channel.send(f"settings have been updated for {user.display_name}")
 
     @commands.command(brief="Get morning club info")
     async def info(self, ctx, user: discord.Member = None):
-        """Get info about the morning club
+        """Get info about the morning club, a page of members at a time, or about a
+        member
 
         Examples
         --------
@@ -533,25 +2938,183 @@ class RiseNGrind(commands.Cog):
 
         !info @janedoe
         """
-        # TODO: prettier info stuff
-        async with self.db.acquire() as con:
-            if not user:
-                message = "Config: "
-                message += str(await con.fetchrow("SELECT * FROM configs WHERE cid=0;"))
-                message += "\n\nActive Members: "
-                message += str([k.display_name for k in self.loops])
-                message += "\n\nMembers: "
-                message += str(await con.fetch("SELECT * FROM members;"))
+        guild = self.guilds[ctx.guild.id]
+        if not user:
+            pages = InfoPages(functools.partial(self.info_page, guild), ctx.author)
+            pages.message = await ctx.channel.send(
+                embed=await pages.render(), view=pages
+            )
+            return
+
+        data = guild.members.get(user.id)
+        if not data:
+            await ctx.channel.send(f"{user.display_name} is not a member")
+            return
+        await ctx.channel.send(str(data))
+
+    async def info_page(self, guild, after, number):
+        """Returns the embed of the !info page of guild's members after mid after,
+        and the mid the next page starts after (None if it's the last)."""
+        query_tag.set("info")
+        now = current_datetime()
+        # a member's current window is dated at most two days behind utc (a day
+        # for their timezone and one for a window that crosses midnight)
+        since = now.date() - datetime.timedelta(days=2)
+        async with self.reader.acquire() as con:
+            rows = await con.fetch(
+                MEMBERS_PAGE, guild.id, after, INFO_PAGE_SIZE + 1, since
+            )
+        more = len(rows) > INFO_PAGE_SIZE
+        rows = rows[:INFO_PAGE_SIZE]
+        names = await self.display_names(guild, [row["mid"] for row in rows])
+
+        lines = []
+        for name, row in zip(names, rows):
+            # the morning shown is the one of the member's current window, the
+            # same one their voice joins count towards
+            today = row["morning_date"] == self.calendar.window(guild.id, row, now).date
+            line = (
+                f"**{name}** {row['start_time']:%H:%M}-{row['end_time']:%H:%M} "
+                f"{row['tz'] or self.calendar.default}"
+            )
+            if row["weekends"]:
+                line += ", weekends"
+            if not row["active"]:
+                line += ", inactive"
+            elif today and row["woke_up"]:
+                line += f", woke up, {row['current_streak']} day streak"
+            elif today and row["notified"]:
+                line += ", slept in"
             else:
-                data = await con.fetchrow(
-                    "SELECT * FROM members WHERE mid = $1;", user.id
-                )
-                if not data:
-                    await ctx.channel.send(f"{user.display_name} is not a member")
-                    return
-                message = str(data)
+                line += f", not up yet, {row['current_streak']} day streak"
+            lines.append(line)
+
+        embed = discord.Embed(
+            title="Morning club", description="\n".join(lines) or "no members yet"
+        )
+        embed.add_field(
+            name="Text channel", value=guild.chat.mention if guild.chat else "not set"
+        )
+        embed.add_field(
+            name="Voice channel",
+            value=guild.voice.mention if guild.voice else "not set",
+        )
+        pages = max(1, -(-len(guild.members) // INFO_PAGE_SIZE))
+        embed.set_footer(text=f"page {number} of {pages}, {len(guild.members)} members")
+        return embed, rows[-1]["mid"] if more else None
+
+    @commands.command(brief="Get a member's streaks and wake up rate")
+    async def stats(self, ctx, user: discord.Member):
+        """Get a member's streaks and wake up rate
+
+        Examples
+        --------
+        !stats @janedoe
+        """
+        guild = self.guilds[ctx.guild.id]
+        if not guild.members.get(user.id):
+            await ctx.channel.send(f"{user.display_name} is not a member")
+            return
+
+        async with self.reader.acquire() as con:
+            stats = await con.fetchrow(
+                "SELECT * FROM member_stats WHERE gid = $1 AND mid = $2;",
+                guild.id,
+                user.id,
+            )
+        if not stats:
+            await ctx.channel.send(f"{user.display_name} has no mornings yet")
+            return
+
+        mornings = stats["total_woke_up"] + stats["total_missed"]
+        await ctx.channel.send(
+            f"{user.display_name}: {stats['current_streak']} day streak "
+            f"(longest {stats['longest_streak']}), woke up for "
+            f"{stats['total_woke_up']}/{mornings} mornings "
+            f"({stats['total_woke_up'] / mornings:.0%})"
+        )
+
+    @commands.command(brief="Get the members with the longest streaks")
+    async def leaderboard(self, ctx, count: int = 10):
+        """Get the members with the longest current streaks
+
+        Examples
+        --------
+        !leaderboard
+
+        !leaderboard 3
+        """
+        guild = self.guilds[ctx.guild.id]
+        count = max(1, min(count, LEADERBOARD_LIMIT))
+        async with self.reader.acquire() as con:
+            leaders = await con.fetch(
+                "SELECT * FROM member_stats WHERE gid = $1 "
+                "ORDER BY current_streak DESC, longest_streak DESC, mid "
+                "LIMIT $2;",
+                guild.id,
+                count,
+            )
+        if not leaders:
+            await ctx.channel.send("no mornings yet")
+            return
+
+        names = await self.display_names(guild, [stats["mid"] for stats in leaders])
+        message = "\n".join(
+            f"{rank}. {name}: "
+            f"{stats['current_streak']} day streak "
+            f"(longest {stats['longest_streak']})"
+            for rank, (name, stats) in enumerate(zip(names, leaders), start=1)
+        )
         await ctx.channel.send(message)
 
+    @commands.group(brief="Inspect the in-process cache", invoke_without_command=True)
+    async def cache(self, ctx):
+        """Inspect the in-process cache
+
+        Examples
+        --------
+        !cache stats
+        """
+        await ctx.send_help(ctx.command)
+
+    @cache.command(name="stats", brief="Show cache hit/miss counts and size")
+    async def cache_stats(self, ctx):
+        """Show cache hit/miss counts and size
+
+        Examples
+        --------
+        !cache stats
+        """
+        guild = self.guilds[ctx.guild.id]
+        config = "loaded" if guild.config else "not loaded"
+        await ctx.channel.send(
+            f"{guild.members}\n{self.names}\n{self.calendar}\nconfig: {config}\n"
+            f"voice events: {self.events_processed} processed, "
+            f"{self.events_dropped} dropped"
+        )
+
+    @cache.command(name="gateway", brief="Show gateway event rates and memory use")
+    async def cache_gateway(self, ctx):
+        """Show gateway event rates and memory use, to compare lean gateway mode
+        against the default
+
+        Examples
+        --------
+        !cache gateway
+        """
+        uptime = time.monotonic() - self.started
+        lines = [
+            f"peak memory: {max_rss() / 2**20:.1f} MiB",
+            f"cached by discord.py: {len(self.bot.users)} users, "
+            f"{sum(len(guild.members) for guild in self.bot.guilds)} members",
+            f"gateway events over {uptime:.0f}s:",
+        ]
+        lines.extend(
+            f"{event}: {count} ({count / uptime:.2f}/s)"
+            for event, count in self.gateway_events.most_common()
+        )
+        await ctx.channel.send("\n".join(lines))
+
     @commands.command(brief="Set text channel")
     async def set_text_channel(self, ctx, chat: discord.TextChannel):
         """Set text channel
@@ -560,13 +3123,18 @@ class RiseNGrind(commands.Cog):
         --------
         !set_text_channel #text-channel
         """
+        guild = self.guilds[ctx.guild.id]
         async with self.db.acquire() as con:
             async with con.transaction():
-                await con.execute(
-                    "UPDATE configs SET text_channel=$1 WHERE cid=0;", chat.id
+                config = await con.fetchrow(
+                    "UPDATE configs SET text_channel=$1 WHERE gid=$2 RETURNING *;",
+                    chat.id,
+                    guild.id,
                 )
-        self.chat = chat
-        await ctx.channel.send(f"text channel set to {self.chat.name}")
+                await self.publish(con, "configs", guild.id)
+            guild.config = config
+        guild.chat = chat
+        await ctx.channel.send(f"text channel set to {guild.chat.name}")
 
     @commands.command(brief="Set voice channel")
     async def set_voice_channel(self, ctx, voice: discord.VoiceChannel):
@@ -576,48 +3144,142 @@ class RiseNGrind(commands.Cog):
         --------
         !set_voice_channel <#VOICE_CHANNEL_ID>
         """
+        guild = self.guilds[ctx.guild.id]
         async with self.db.acquire() as con:
             async with con.transaction():
-                await con.execute(
-                    "UPDATE configs SET voice_channel=$1 WHERE cid=0;", voice.id
+                config = await con.fetchrow(
+                    "UPDATE configs SET voice_channel=$1 WHERE gid=$2 RETURNING *;",
+                    voice.id,
+                    guild.id,
                 )
-        self.voice = voice
-        await ctx.channel.send(f"voice channel set to {self.voice.name}")
+                await self.publish(con, "configs", guild.id)
+            guild.config = config
+        guild.voice = voice
+        guild.rebuild_prefilter()
+        await ctx.channel.send(f"voice channel set to {guild.voice.name}")
+
+
+async def import_files(paths, gid):
+    """Imports csv files of members or mornings into guild gid without starting
+    the bot, see RiseNGrind.import_."""
+    con = await asyncpg.connect(
+        database=os.environ["DB_NAME"],
+        user=os.environ["DB_USER"],
+        password=os.environ["DB_PASS"],
+        host=os.environ["DB_HOST"],
+        port=os.environ["DB_PORT"],
+    )
+    try:
+        await migrate(con)
+        for path in paths:
+            started = time.monotonic()
+            opener = gzip.open if path.endswith(".gz") else open
+            try:
+                with opener(path, "rt", encoding="utf-8", newline="") as lines:
+                    table, imported, skipped = await import_csv(
+                        con, gid, lines, "import"
+                    )
+            except (InvalidImport, *READ_ERRORS) as e:
+                print(f"nothing imported from {path}:\n{e}")
+                continue
+            print(
+                f"imported {imported} {table} from {path} ({skipped} skipped) "
+                f"in {time.monotonic() - started:.2f}s"
+            )
+    finally:
+        await con.close()
 
 
 async def main():
     # cli
     parser = argparse.ArgumentParser()
     parser.add_argument("--dev", action="store_true")
+    parser.add_argument(
+        "--import",
+        dest="imports",
+        nargs="+",
+        metavar="CSV",
+        help="import csv files of members or mornings into DISCORD_GUILD and exit",
+    )
     args = parser.parse_args()
+    # the guild that adopts the rows from before there were guilds. never the test
+    # guild, a dev run against the shared database would move everyone into it
+    adopt_guild_id = 0 if args.dev else int(os.environ.get("DISCORD_GUILD", 0))
     if args.dev:
         os.environ["DISCORD_GUILD"] = os.environ["TEST_DISCORD_GUILD"]
+    if args.imports:
+        await import_files(args.imports, int(os.environ["DISCORD_GUILD"]))
+        return
+    # fail now rather than once the bot has connected and starts scheduling
+    timezone = os.environ.get("TZ", DEFAULT_TIMEZONE)
+    try:
+        zoneinfo.ZoneInfo(timezone)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        parser.error(f"TZ={timezone} is not a timezone, use a name like Europe/Paris")
+
+    discord.utils.setup_logging()
+
+    # lean gateway mode only asks for the events the cog uses and doesn't cache or
+    # chunk members, they are fetched when needed instead
+    intents = discord.Intents().all()
+    if env_flag("LEAN_GATEWAY"):
+        intents = discord.Intents(
+            guilds=True, voice_states=True, guild_messages=True, message_content=True
+        )
 
-    # set timezone
-    if "TZ" not in os.environ:
-        os.environ["TZ"] = "UTC"
-    time.tzset()
-
-    # discord bot
-    # TODO: only use necessary intents
-    bot = commands.Bot(
+    # discord bot, sharded automatically once it's in enough guilds to need it
+    bot = commands.AutoShardedBot(
         command_prefix="!",
-        intents=discord.Intents().all(),
+        intents=intents,
         description="Rise and grind!",
+        chunk_guilds_at_startup=intents.members,
+        member_cache_flags=discord.MemberCacheFlags.from_intents(intents),
     )
 
     # register cog
     risengrind = RiseNGrind(
         bot=bot,
-        guild_id=int(os.environ["DISCORD_GUILD"]),
+        guild_id=adopt_guild_id,
         db_name=os.environ["DB_NAME"],
         db_user=os.environ["DB_USER"],
         db_pass=os.environ["DB_PASS"],
         db_host=os.environ["DB_HOST"],
         db_port=os.environ["DB_PORT"],
+        leader_election=env_flag("LEADER_ELECTION"),
+        retention_days=int(os.environ.get("RETENTION_DAYS", 0)),
+        retention_archive=env_flag("RETENTION_ARCHIVE"),
+        partitioned=env_flag("MORNINGS_PARTITIONED"),
+        metrics_port=int(os.environ.get("METRICS_PORT", METRICS_PORT)),
+        slow_query=float(os.environ.get("SLOW_QUERY_SECONDS", SLOW_QUERY_SECONDS)),
+        explain_sample=float(os.environ.get("EXPLAIN_SAMPLE", 0)),
+        pool_min_size=int(os.environ.get("DB_POOL_MIN", POOL_MIN_SIZE)),
+        pool_max_size=int(os.environ.get("DB_POOL_MAX", POOL_MAX_SIZE)),
+        pool_idle_lifetime=float(
+            os.environ.get("DB_POOL_IDLE_LIFETIME", POOL_IDLE_LIFETIME)
+        ),
+        statement_cache_size=int(
+            os.environ.get("DB_STATEMENT_CACHE_SIZE", STATEMENT_CACHE_SIZE)
+        ),
+        pgbouncer=env_flag("DB_PGBOUNCER"),
+        replica_dsn=os.environ.get("DB_REPLICA_DSN"),
+        timezone=timezone,
+        join_batch_window=float(
+            os.environ.get("JOIN_BATCH_SECONDS", JOIN_BATCH_WINDOW)
+        ),
+        shutdown_timeout=float(os.environ.get("SHUTDOWN_TIMEOUT", SHUTDOWN_TIMEOUT)),
     )
     await bot.add_cog(risengrind)
 
+    # fly stops machines with a signal, drain before disconnecting from discord so
+    # the last greetings still go out
+    async def shutdown():
+        await risengrind.close()
+        await bot.close()
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, lambda: asyncio.create_task(shutdown()))
+
     # start the bot
     await bot.start(os.environ["DISCORD_TOKEN"])
 
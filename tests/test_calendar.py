@@ -0,0 +1,67 @@
+import datetime
+
+import bot
+
+
+def member(start, end, tz=None, weekends=True):
+    return {
+        "mid": 1,
+        "start_time": start,
+        "end_time": end,
+        "weekends": weekends,
+        "tz": tz,
+    }
+
+
+def test_spring_forward_window_keeps_its_length():
+    # on 2024-03-10 new york's clocks skip from 02:00 to 03:00
+    calendar = bot.Calendar("UTC")
+    window = calendar.next_window(
+        member(datetime.time(2, 30), datetime.time(3), "America/New_York"),
+        datetime.datetime(2024, 3, 10, 5),
+    )
+    assert window.date == datetime.date(2024, 3, 10)
+    assert window.start == datetime.datetime(2024, 3, 10, 6, 30)
+    assert window.end == datetime.datetime(2024, 3, 10, 7)
+    assert window.deadline == window.end + bot.DEADLINE_GRACE
+
+    # later that morning new york is on daylight saving time
+    window = calendar.next_window(
+        member(datetime.time(6), datetime.time(7), "America/New_York"),
+        datetime.datetime(2024, 3, 10, 5),
+    )
+    assert window.start == datetime.datetime(2024, 3, 10, 10)
+    assert window.end == datetime.datetime(2024, 3, 10, 11)
+
+
+def test_fall_back_window_spans_both_readings():
+    # on 2024-11-03 new york's clocks go through 01:00 to 02:00 twice
+    calendar = bot.Calendar("UTC")
+    window = calendar.next_window(
+        member(datetime.time(1, 30), datetime.time(1, 45), "America/New_York"),
+        datetime.datetime(2024, 11, 3, 4),
+    )
+    assert window.date == datetime.date(2024, 11, 3)
+    assert window.start == datetime.datetime(2024, 11, 3, 5, 30)
+    assert window.end == datetime.datetime(2024, 11, 3, 6, 45)
+
+    window = calendar.next_window(
+        member(datetime.time(6), datetime.time(7), "America/New_York"),
+        datetime.datetime(2024, 11, 3, 4),
+    )
+    assert window.start == datetime.datetime(2024, 11, 3, 11)
+    assert window.end == datetime.datetime(2024, 11, 3, 12)
+
+
+def test_weekends_are_skipped():
+    calendar = bot.Calendar("UTC")
+    # friday, after the window closed
+    now = datetime.datetime(2024, 1, 5, 9)
+    window = calendar.next_window(
+        member(datetime.time(6), datetime.time(8), weekends=False), now
+    )
+    assert window.date == datetime.date(2024, 1, 8)
+    assert window.start == datetime.datetime(2024, 1, 8, 6)
+
+    window = calendar.next_window(member(datetime.time(6), datetime.time(8)), now)
+    assert window.date == datetime.date(2024, 1, 6)